@@ -0,0 +1,141 @@
+################# Benchmarks for the ReCom kernels & whole chains #################
+# python benchmark.py                      (everything)
+# python benchmark.py chain                (just bench_chain; also trees, uniformity)
+# Runs fully offline: chains run on synthetic graphs (see src/synthetic.py) & never touch BigQuery.
+from src.scheduler import *
+from src.synthetic import *
+import itertools as it, sys, resource
+
+def grid_csr(rows, cols):
+    # CSR (indptr, indices) & networkx version of a rows x cols grid graph
+    G = nx.convert_node_labels_to_integers(nx.grid_2d_graph(rows, cols), ordering='sorted')
+    indptr = np.zeros(G.number_of_nodes()+1, dtype=np.int64)
+    indptr[1:] = np.cumsum([G.degree[n] for n in range(G.number_of_nodes())])
+    indices = np.array([m for n in range(G.number_of_nodes()) for m in sorted(G[n])], dtype=np.int64)
+    return G, indptr, indices
+
+
+def kruskal_tree(G, rng):
+    # the spanning tree sampler MCMC.recomb used before wilson_tree
+    for e in get_edges(G):
+        G.edges[e]['weight'] = rng.uniform()
+    return nx.minimum_spanning_tree(G)
+
+
+def bench_trees(sizes=(10, 30, 60), reps=20, random_seed=0):
+    print('spanning tree sampler (sec per tree)')
+    for n in sizes:
+        G, indptr, indices = grid_csr(n, n)
+        rng = np.random.default_rng(random_seed)
+        start = time.time()
+        for r in range(reps):
+            kruskal_tree(G, rng)
+        t_kruskal = (time.time() - start) / reps
+        start = time.time()
+        for r in range(reps):
+            wilson_tree(indptr, indices, rng)
+        t_wilson = (time.time() - start) / reps
+        print(f'{n}x{n} grid'.ljust(rpt_just, ' ') + f'kruskal={t_kruskal:.5f}  wilson={t_wilson:.5f}  speedup={t_kruskal/t_wilson:.1f}x')
+
+
+def bench_uniformity(rows=3, cols=3, samples=20000, random_seed=0):
+    # Total variation distance between each sampler's empirical tree distribution & the uniform distribution.
+    # A 3x3 grid has 192 spanning trees, so both samplers are compared over every tree.
+    G, indptr, indices = grid_csr(rows, cols)
+    trees = [tuple(sorted(tuple(sorted(e)) for e in E)) for E in it.combinations(get_edges(G), G.number_of_nodes()-1)
+             if nx.is_tree(nx.Graph(list(E)))]
+    print(f'spanning tree uniformity on {rows}x{cols} grid ({len(trees)} trees, {samples} samples)')
+    rng = np.random.default_rng(random_seed)
+    samplers = {'kruskal': lambda: get_edges(kruskal_tree(G, rng)),
+                'wilson' : lambda: tuple(sorted(tuple(sorted(e)) for e in tree_edges(wilson_tree(indptr, indices, rng)).tolist()))}
+    for name, sampler in samplers.items():
+        counts = dict.fromkeys(trees, 0)
+        for s in range(samples):
+            counts[tuple(sorted(sampler()))] += 1
+        tv = np.abs(np.array(list(counts.values())) / samples - 1 / len(trees)).sum() / 2
+        print(name.ljust(rpt_just, ' ') + f'total variation from uniform = {tv:.4f}')
+
+
+def bench_case(kind, n, district_type, steps, time_budget, save_period, pop_deviation_target, random_seed, results):
+    # One chain on a fresh synthetic graph, run in its own process so ru_maxrss is this case's peak memory alone.
+    # Mirrors the loop in MCMC.run_chain, but drops records every save_period steps instead of saving them.
+    start = time.perf_counter()
+    n_districts = Base().Seats[district_type]
+    G = synthetic_graph(n, kind, n_districts=n_districts, random_seed=random_seed)
+    t_graph = time.perf_counter() - start
+    letter = {t: c for c, t in Base().District_types.items()}[district_type]
+    opts = proposal_defaults(f'plan{letter}0000')
+    if pop_deviation_target is not None:
+        opts['pop_deviation_target'] = pop_deviation_target
+    M = MCMC.offline(G, district_type, proposal=f'plan{letter}0000', random_seed=random_seed, max_steps=steps, **opts)
+    t_setup = time.perf_counter() - start - t_graph
+    M.record()
+    start = time.perf_counter()
+    reached = 0.0 if M.pop_deviation <= M.pop_deviation_target else None
+    while M.plan < steps and time.perf_counter() - start < time_budget:
+        M.plan += 1
+        if M.recomb() is False:
+            M.plan -= 1
+            break
+        M.record()
+        if M.plan % save_period == 0:
+            for src, R in M.recs.items():
+                if src != 'hash':
+                    R.clear()
+        if reached is None and M.pop_deviation <= M.pop_deviation_target:
+            reached = time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+    T = {a: M.totals[a] + M.step_stats[a] for a in M.totals}
+    results.put({'kind': kind, 'nodes': G.number_of_nodes(), 'district_type': district_type, 'districts': n_districts,
+                 'steps': M.plan, 'steps_per_sec': M.plan / max(elapsed, 1e-9), 'graph_sec': t_graph, 'setup_sec': t_setup,
+                 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 'pop_target_sec': reached,
+                 'pop_deviation': M.pop_deviation, **T})
+
+
+def bench_chain(kinds=('grid', 'voronoi'), sizes=(1000, 10000), district_types=('cd', 'sldu', 'sldl'), steps=200, time_budget=60,
+                save_period=50, pop_deviation_target=None, random_seed=0, out=None, baseline=None, tolerance=0.2):
+    # steps/sec, peak memory, & seconds to reach pop_deviation_target for every (kind, size, district_type).
+    # pop_deviation_target defaults to the proposal default for the district type (see proposal_defaults); None in pop_target_sec means not reached.
+    # Writes every result to out (json) if given.  With baseline (a json written by an earlier run),
+    # flags every case whose steps/sec fell more than tolerance below the baseline & returns those cases.
+    ctx = multiprocessing.get_context('spawn')
+    results = list()
+    print('chains on synthetic graphs')
+    for kind, n, district_type in it.product(kinds, sizes, district_types):
+        q = ctx.Queue()
+        p = ctx.Process(target=bench_case, args=(kind, n, district_type, steps, time_budget, save_period, pop_deviation_target, random_seed, q))
+        p.start()
+        r = None
+        while r is None and (p.is_alive() or not q.empty()):
+            try:
+                r = q.get(timeout=1)
+            except queue.Empty:
+                pass
+        p.join()
+        if r is None:
+            print(f'{kind} {n} {district_type} failed (exit code {p.exitcode})', flush=True)
+            continue
+        results.append(r)
+        reached = 'not reached' if r['pop_target_sec'] is None else f'{r["pop_target_sec"]:.2f}sec'
+        top = sorted(phases, key=lambda a: -r[f'time_{a}'])[:2]
+        print(f'{kind} {r["nodes"]} {district_type}'.ljust(2*rpt_just, ' ') + f'{r["steps_per_sec"]:8.2f} steps/sec  {r["max_rss_mb"]:8.0f}MB  pop target {reached}  '
+              + f'(graph {r["graph_sec"]:.1f}sec, setup {r["setup_sec"]:.1f}sec, most time in {" & ".join(top)})', flush=True)
+    if out is not None:
+        with open(out, 'w') as f:
+            json.dump(results, f, indent=4)
+    slow = list()
+    if baseline is not None:
+        with open(baseline, 'r') as f:
+            base = {(b['kind'], b['nodes'], b['district_type']): b for b in json.load(f)}
+        for r in results:
+            b = base.get((r['kind'], r['nodes'], r['district_type']))
+            if b is not None and r['steps_per_sec'] < (1 - tolerance) * b['steps_per_sec']:
+                print(f'REGRESSION {r["kind"]} {r["nodes"]} {r["district_type"]}: {r["steps_per_sec"]:.2f} steps/sec vs {b["steps_per_sec"]:.2f} in {baseline}', flush=True)
+                slow.append(r)
+    return slow
+
+
+if __name__ == '__main__':
+    benches = {'trees': bench_trees, 'uniformity': bench_uniformity, 'chain': bench_chain}
+    for name in sys.argv[1:] or benches:
+        benches[name]()
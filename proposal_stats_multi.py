@@ -1,13 +1,3 @@
-################# Set hashseed for reproducibility #################
-HASHSEED = '0'
-try:
-    notebook
-except:
-    import os, sys
-    if os.getenv('PYTHONHASHSEED') != HASHSEED:
-        os.environ['PYTHONHASHSEED'] = HASHSEED
-        os.execv(sys.executable, [sys.executable] + sys.argv)
-
 from src.mcmc import *
 import multiprocessing, itertools as it
 
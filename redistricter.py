@@ -1,16 +1,6 @@
-################# Set hashseed for reproducibility #################
-HASHSEED = '0'
-try:
-    notebook
-except:
-    import os, sys
-    if os.getenv('PYTHONHASHSEED') != HASHSEED:
-        os.environ['PYTHONHASHSEED'] = HASHSEED
-        os.execv(sys.executable, [sys.executable] + sys.argv)
-
 ################# Initial Setup #################
-from src.mcmc import *
-import multiprocessing
+from src.scheduler import *
+import sys, multiprocessing
 opts = {
     'abbr'                 : 'TX',
     'level'                : 'cntyvtd',
@@ -33,55 +23,44 @@ run_opts = {
     'workers'         : 80,
 }
 
-if opts['proposal'][4] == 'c':
-    opts['pop_deviation_target'] = 0.01
-    opts['defect_cap'] = 60
-elif opts['proposal'][4] == 's':
-    opts['pop_deviation_target'] = 10.0
-    opts['defect_cap'] = 35
-elif opts['proposal'][4] == 'h':
-    opts['pop_deviation_target'] = 10.0
-    opts['defect_cap'] = 10
-else:
-    raise Exception(f'unknown proposal {opts["proposal"]}')
+opts.update(proposal_defaults(opts['proposal']))
 
+# python redistricter.py [(r)un | (p)ost-process each run | (c)onsolidate results] [job_spec.json]
+# run uses job_spec.json if given (see src/scheduler.py), else the options above.  Any other task just prints the options.
+task = sys.argv[1].lower() if len(sys.argv) > 1 else ''
 for opt, val in {**opts, **run_opts}.items():
     print(f'{opt.ljust(22, " ")}: {val}')
 
-task = input('Using options above - do you want to (r)un MCMC, (p)ost-process each run, (c)onsolidate results, or any other to quit: ').lower()
-
 a = run_opts['seed_start']
 b = min(a + run_opts['jobs_per_worker'] * run_opts['workers'], run_opts['seed_stop'])
 random_seeds = np.arange(a, b)
 
-if task in ['r', 'run', 'p']:
-    def f(random_seed):
-        print(f'starting seed {random_seed}')
-        M = MCMC(random_seed=random_seed, **opts)
-        if task == 'p':
-            print('post-processing')
-            try:
-                M.post_process()
-            except Exception as e:
-                print(f'{random_seed} exception')
-        else:
-            M.run_chain()
-        return M
-
-    def multi_f(random_seed):
-        time.sleep(multiprocessing.current_process()._identity[0] / 100)
-        return f(random_seed)
+if task in ['r', 'run']:
+    start_time = time.time()
+    if len(sys.argv) > 2:
+        spec = JobSpec.read(sys.argv[2])
+    else:
+        spec = JobSpec(proposals=[opts['proposal']], levels=[opts['level']], contracts=[opts['contract']], seeds=random_seeds,
+                       max_steps=opts['max_steps'], workers=run_opts['workers'],
+                       opts={k: v for k, v in opts.items() if k not in ['proposal', 'level', 'contract', 'max_steps']})
+    failed = Scheduler(spec).run()
+    print(f'{len(failed)} chains failed')
+    print(f'total time elapsed = {time_formatter(time.time() - start_time)}')
 
 
+elif task in ['p', 'post-process']:
     start_time = time.time()
     M = MCMC(**opts)#, refresh_all=('proposals'))
 
-    if run_opts['workers'] == 1:
-        for s in random_seeds:
-            M = f(s)
-    else:
-        with multiprocessing.Pool(run_opts['workers']) as pool:
-            M = pool.map(multi_f, random_seeds)
+    def f(random_seed):
+        print(f'post-processing seed {random_seed}')
+        try:
+            M.spawn(random_seed).post_process()
+        except Exception as e:
+            print(f'{random_seed} exception')
+
+    with multiprocessing.Pool(run_opts['workers']) as pool:
+        pool.map(f, random_seeds)
     print(f'total time elapsed = {time_formatter(time.time() - start_time)}')
 
 
@@ -90,9 +69,8 @@ elif task in ['c', 'consolidate']:
     start = time.time()
     
     src_tbls = dict()
-    for t in bqclient.list_tables(M.dataset):
-        full  = t.full_table_id.replace(':', '.')
-        short = t.table_id
+    for full in list_tables(M.dataset):
+        short = full.split('.')[-1]
         w = short.split('_')
         try:
             assert len(w) >= 4 and w[0] == M.level and w[1] == M.contract and int(w[2]) in random_seeds
@@ -137,6 +115,8 @@ order by
     overwrite = True
     for seed, tbls in src_tbls.items():
         rpt(f'starting {seed}')
+        # plan tables are delta-encoded (see src/history.py) - expand them to full plans before filtering
+        tbls = {**tbls, 'plan': f"(\n    {subquery(expand_plan_query(tbls['plan'], tbls['summary']), 2)}\n    )"}
         for key, val in final.items():
             if key not in ['hashes', 'stats']:
                 rpt(key)
@@ -2,24 +2,18 @@ proj_id   = 'cmat-315920'
 root_path = '/home/jupyter/'
 gcs_path  = 'math_for_unbiased_maps_tx'
 
-import os, pathlib, shutil, time, datetime, dataclasses, typing, google.cloud.bigquery
-import numpy as np, pandas as pd, geopandas as gpd, networkx as nx
+import os, pathlib, shutil, time, datetime, dataclasses, typing, hashlib, copy, json, collections, threading
+import numpy as np, pandas as pd, networkx as nx
 from collections import defaultdict
-
-try:
-    import google.cloud.bigquery_storage
-except:
-    os.system('pip install --upgrade google-cloud-bigquery-storage')
-    import google.cloud.bigquery_storage
+from .backends import *
+from .querycache import *
+from .manifest import *
 
 import warnings
 warnings.filterwarnings('ignore', message='.*initial implementation of Parquet.*')
 warnings.filterwarnings('ignore', message='.*Pyarrow could not determine the type of columns*')
 
 pd.set_option('display.max_columns', None)
-cred, proj = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
-bqclient   = google.cloud.bigquery.Client(credentials=cred, project=proj)
-gcsclient  = google.cloud.storage .Client(credentials=cred, project=proj)
 
 root_path    = pathlib.Path(root_path)
 root_bq      = proj_id
@@ -27,6 +21,26 @@ data_bq      = root_bq   +'.redistricting_data'
 data_path    = root_path / 'redistricting_data'
 code_path    = root_path / 'MathVGerrmandering_CMAT_2021'
 
+# where every table lives - see backends.py.  Set REDISTRICTING_BACKEND=duckdb to work offline on local Parquet files.
+# The BigQuery & Cloud Storage clients are created on first use, so importing src does not authenticate or touch the network.
+backend = get_backend(root=data_path / 'warehouse')
+if isinstance(backend, BigQueryBackend):  # still exported for notebooks
+    bqclient, gcsclient = LazyClient(backend, 'client'), LazyClient(backend, 'gcs')
+
+query_cache = None  # see enable_query_cache
+
+def enable_query_cache(root=None, max_bytes=10 * 2**30):
+    """Cache run_query results on local disk (see querycache.py); also enabled by setting REDISTRICTING_QUERY_CACHE to a directory"""
+    global query_cache
+    query_cache = QueryCache(root or data_path / 'query_cache', max_bytes)
+    return query_cache
+
+if os.getenv('REDISTRICTING_QUERY_CACHE'):
+    enable_query_cache(os.getenv('REDISTRICTING_QUERY_CACHE'))
+
+# which tables exist & their columns, so check_table & get_cols make no network calls - see manifest.py
+manifest = TableManifest(backend, backend.root / '_manifest' if isinstance(backend, DuckDBBackend) else data_path / 'manifest')
+
 # https://gis.stackexchange.com/questions/27702/what-is-the-srid-of-census-gov-shapefiles
 crs_census = 'EPSG:4269'
 crs_area   = 'ESRI:102003'
@@ -98,11 +112,12 @@ class Base():
     
     def delete_for_refresh(self, src):
         tbl = self.tbls[src]
+        if src in self.refresh_tbl:  # relist so tables changed elsewhere are seen
+            manifest.refresh(tbl[:tbl.rfind('.')])
         if src in self.refresh_all:
             shutil.rmtree(self.path[src], ignore_errors=True)
             dataset = tbl[:tbl.rfind('.')]
-            for t in bqclient.list_tables(dataset):
-                nm = t.full_table_id.replace(':', '.')
+            for nm in list_tables(dataset):
                 if tbl in nm:
                     delete_table(nm)
         if src in self.refresh_tbl:
@@ -111,19 +126,61 @@ class Base():
                 delete_table(tbl)
 
     def get(self, src):
+        # True if src was (re)built, False if its existing table was used
         rpt(f'Get {src}'.ljust(rpt_just, ' '))
         self.delete_for_refresh(src)
         if check_table(self.tbls[src]):
             rpt('using existing table')
+            built = False
         else:
             rpt('processing')
             self[f'get_{src}']()
-        print(f'success!')
-        os.chdir(code_path)
-
-
-def rpt(msg):
-    print(msg, end=concat_str, flush=True)
+            built = True
+        rpt(f'success!', end='\n')
+        return built
+
+    def get_sources(self, inputs, workers=1):
+        # Get every source in inputs, a dict {src: sources it reads}, as a DAG: a source starts once all its inputs are done,
+        # & up to workers sources run at once on a thread pool (the work is downloads & warehouse jobs, which release the GIL).
+        # A source that is (re)built adds every source reading it to refresh_tbl, so stale downstream tables are rebuilt.
+        # With several workers, each source's rpt messages are held & printed as one line when it finishes.
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+        def run(src):
+            if workers == 1:
+                return self.get(src)
+            rpt_local.lines = list()
+            try:
+                return self.get(src)
+            finally:
+                lines, rpt_local.lines = rpt_local.lines, None
+                with rpt_lock:
+                    print(''.join(lines), end='', flush=True)
+
+        pending, running, done = list(inputs), dict(), set()
+        with ThreadPoolExecutor(workers) as pool:
+            while pending or running:
+                for src in [s for s in pending if setify(inputs[s]).issubset(done)]:
+                    pending.remove(src)
+                    running[pool.submit(run, src)] = src
+                if not running:
+                    raise Exception(f'sources {pending} wait on inputs that are never produced ... check for cycles or unknown sources')
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    src = running.pop(f)
+                    if f.result():
+                        self.refresh_tbl.update(s for s, x in inputs.items() if src in setify(x))
+                    done.add(src)
+
+
+rpt_local = threading.local()  # holds the messages of a source run by Base.get_sources on a worker thread
+rpt_lock  = threading.Lock()
+
+def rpt(msg, end=concat_str):
+    lines = getattr(rpt_local, 'lines', None)
+    if lines is None:
+        print(msg, end=end, flush=True)
+    else:
+        lines.append(f'{msg}{end}')
 
 def lower_cols(df):
     df.rename(columns = {x:str(x).lower() for x in df.columns}, inplace=True)
@@ -147,7 +204,8 @@ def time_formatter(t):
     return f'{int(h)}hrs {int(m)}min {s:.2f}sec'
     
 def extract_file(zipfile, fn, **kwargs):
-    file = zipfile.extract(fn)
+    # extract beside the zip file itself, not into the working directory, so sources can run on separate threads
+    file = zipfile.extract(fn, pathlib.Path(zipfile.filename).parent)
     return lower_cols(pd.read_csv(file, dtype=str, **kwargs))
 
 def join_str(indents=1):
@@ -159,30 +217,27 @@ def subquery(query, indents=1):
     return query.strip().replace('\n', s)
 
 def check_table(tbl):
-    try:
-        bqclient.get_table(tbl)
-        return True
-    except:
-        return False
+    return manifest.exists(tbl)
 
 def get_cols(tbl):
     """Get list of columns on tbl"""
-    t = bqclient.get_table(tbl)
-    return [s.name for s in t.schema]
+    return manifest.columns(tbl)
     
-def run_query(query):
-    res = bqclient.query(query).result()
-    try:
-        return res.to_dataframe()
-    except:
-        return True
+def run_query(query, cache=True):
+    if query_cache is None or not cache:
+        return backend.query(query)
+    return query_cache.run(backend, query, manifest)
 
 def delete_table(tbl):
-    query = f"drop table {tbl}"
-    try:
-        run_query(query)
-    except google.api_core.exceptions.NotFound:
-        pass
+    backend.delete(tbl)
+    manifest.update(tbl)
+
+def create_dataset(dataset):
+    backend.create_dataset(dataset)
+
+def list_tables(dataset):
+    """Full names of every table in dataset"""
+    return manifest.names(dataset)
 
 def read_table(tbl, rows=99999999999, start=0, cols='*'):
     query = f'select {", ".join(cols)} from {tbl} limit {rows}'
@@ -196,15 +251,10 @@ def load_table(tbl, df=None, query=None, file=None, overwrite=True, preview_rows
     if overwrite:
         delete_table(tbl)
     
-    if df is not None:
-        job = bqclient.load_table_from_dataframe(df, tbl).result()
-    elif query is not None:
-        job = bqclient.query(query, job_config=google.cloud.bigquery.QueryJobConfig(destination=tbl, write_disposition='write_append')).result()
-    elif file is not None:
-        with open(file, mode='rb') as f:
-            job = bqclient.load_table_from_file(f, tbl, job_config=google.cloud.bigquery.LoadJobConfig(autodetect=True)).result()
-    else:
+    if df is None and query is None and file is None:
         raise Exception('at least one of df, query, or file must be specified')
+    backend.load(tbl, df=df, query=query, file=file)
+    manifest.update(tbl)
     
     df = True
     if preview_rows > 0:
@@ -250,36 +300,49 @@ def get_components_district(G, D, sort=True):
     # get connected components given districts
     return get_components(district_view(G, D))
 
+def node_keys(geoids):
+    # fixed pseudo-random 64-bit key for each geoid - same in every process, notebook, and machine
+    return np.array([int.from_bytes(hashlib.blake2b(str(g).encode(), digest_size=8).digest(), 'little') for g in geoids], dtype=np.uint64)
+
+def mix64(x):
+    # splitmix64 finalizer - a nonlinear bijection on uint64 arrays (arithmetic wraps mod 2**64)
+    x = np.atleast_1d(np.asarray(x, dtype=np.uint64)).copy()
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return x
+
+def plan_key(district_keys):
+    # combine per-district keys (sum of node_keys of its nodes) into one order-independent uint64 key (as a length-1 array)
+    return mix64(district_keys).sum(dtype=np.uint64, keepdims=True)
+
+def partition_hash(key):
+    # plan key as a signed 64-bit int (fits BigQuery INT64)
+    return int(np.asarray(key, dtype=np.uint64).reshape(1).view(np.int64)[0])
+
 def get_hash(G):
-    # Partition hashing provides a unique integer label for each distinct plan
-    # For each district, get sorted tuple of nodes it contains.  Then sort this tuple of tuples.
-    # Produces a sorted tuple of sorted tuples called "partition" that does not care about:
-    # permutations of the nodes within a district OR permutations of the district labels.
-    # WARNING - Python inserts randomness into its hash function for security reasons.
-    # However, this means the same partition gets a different hash in different runs.
-    # The first lines of this .py file fix this issue by setting the hashseen
-    # But this solution does NOT work in a Jupyter notebook, AFAIK.
-    # I have not found a way to force deterministic hashing in Jupyter.
-    return get_partition(G).__hash__()
+    # Partition hashing provides a unique integer label for each distinct plan.
+    # Each district sums the node_keys of its nodes, so it does not care about permutations of the nodes within a district.
+    # Plan hash sums a nonlinear mix of the district sums, so it does not care about permutations of the district labels.
+    # Unlike Python's hash, this is deterministic across processes & Jupyter without setting PYTHONHASHSEED,
+    # and PartitionState can update it in O(moved nodes).
+    nodes, districts = zip(*G.nodes(data='district'))
+    districts, inv = np.unique(districts, return_inverse=True)
+    keys = np.zeros(len(districts), dtype=np.uint64)
+    np.add.at(keys, inv, node_keys(nodes))
+    return partition_hash(plan_key(keys))
 
 
 def get_states():
-    query = f"""
-select
-    state_fips_code as fips
-    , state_postal_abbreviation as abbr
-    , state_name as name
-from
-    bigquery-public-data.census_utility.fips_codes_states
-where
-    state_fips_code <= '56'
-"""
-    return lower_cols(run_query(query)).set_index('name')
+    # FIPS code, postal abbreviation, & name of the 50 states & DC, indexed by name.
+    # Read from states.csv beside this file rather than queried, so importing src needs no network.
+    return pd.read_csv(pathlib.Path(__file__).with_name('states.csv'), comment='#', dtype=str).set_index('name')
 
 try:
     states
 except:
-    print('getting states')
     states = get_states()
 
 ################# Census definitions #################
@@ -0,0 +1,348 @@
+import os, re, pathlib, threading
+
+################# Storage backends #################
+# The table helpers in __init__.py (run_query, load_table, read_table, check_table, get_cols, delete_table, ...) call the
+# methods below on the module-level backend, so the whole pipeline & every chain can run on either engine:
+#     BigQueryBackend    the cloud warehouse (default)
+#     DuckDBBackend      in-process DuckDB with its spatial extension over local Parquet files - no network, no billed scans
+# Tables are always named project.dataset.table, as in BigQuery.
+
+class BigQueryBackend():
+    # The google packages are imported & the clients created on first use of bigquery, NotFound, client, or gcs,
+    # so constructing the backend (at import of src) neither authenticates nor touches the network.
+    def __init__(self):
+        self.lock = threading.Lock()
+
+
+    def connect(self):
+        with self.lock:
+            if 'client' in self.__dict__:
+                return
+            import google.auth, google.cloud.bigquery, google.cloud.storage, google.api_core.exceptions
+            try:
+                import google.cloud.bigquery_storage
+            except:
+                os.system('pip install --upgrade google-cloud-bigquery-storage')
+                import google.cloud.bigquery_storage
+            self.bigquery = google.cloud.bigquery
+            self.NotFound = google.api_core.exceptions.NotFound
+            cred, proj = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+            self.gcs    = google.cloud.storage .Client(credentials=cred, project=proj)
+            self.client = google.cloud.bigquery.Client(credentials=cred, project=proj)
+
+
+    def __getattr__(self, name):
+        # only called for attributes not yet set
+        if name in ('bigquery', 'NotFound', 'client', 'gcs'):
+            self.connect()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+
+    def query(self, query):
+        res = self.client.query(query).result()
+        try:
+            return res.to_dataframe()
+        except:
+            return True
+
+
+    def exists(self, tbl):
+        try:
+            self.client.get_table(tbl)
+            return True
+        except:
+            return False
+
+
+    def columns(self, tbl):
+        return [s.name for s in self.client.get_table(tbl).schema]
+
+
+    def modified(self, tbl):
+        # last-modified time of tbl in milliseconds since the epoch, or None if it does not exist
+        try:
+            return int(self.client.get_table(tbl).modified.timestamp() * 1000)
+        except self.NotFound:
+            return None
+
+
+    def describe(self, dataset):
+        # {full table name: {'columns', 'modified'}} for every table in dataset from two metadata queries, not one call per table
+        try:
+            mod  = self.query(f'select table_id, last_modified_time from `{dataset}.__TABLES__`')
+            cols = self.query(f'select table_name, column_name from `{dataset}.INFORMATION_SCHEMA.COLUMNS` order by table_name, ordinal_position')
+        except self.NotFound:
+            return dict()
+        cols = cols.groupby('table_name', sort=False)['column_name'].agg(list)
+        return {f'{dataset}.{t}': {'columns': cols.get(t, []), 'modified': int(m)} for t, m in zip(mod['table_id'], mod['last_modified_time'])}
+
+
+    def delete(self, tbl):
+        try:
+            self.query(f"drop table {tbl}")
+        except self.NotFound:
+            pass
+
+
+    def create_dataset(self, dataset):
+        self.client.create_dataset(dataset, exists_ok=True)
+
+
+    def list_tables(self, dataset):
+        # full names (project.dataset.table) of every table in dataset
+        return [t.full_table_id.replace(':', '.') for t in self.client.list_tables(dataset)]
+
+
+    def load(self, tbl, df=None, query=None, file=None):
+        # append df, the result of query, or a csv file to tbl
+        if df is not None:
+            self.client.load_table_from_dataframe(df, tbl).result()
+        elif query is not None:
+            self.client.query(query, job_config=self.bigquery.QueryJobConfig(destination=tbl, write_disposition='write_append')).result()
+        elif file is not None:
+            with open(file, mode='rb') as f:
+                self.client.load_table_from_file(f, tbl, job_config=self.bigquery.LoadJobConfig(autodetect=True)).result()
+
+
+    def load_file(self, tbl, file, delimiter, schema):
+        # append a headerless delimited file with the given schema (list of {'name', 'field_type'}) to tbl
+        schema = [self.bigquery.SchemaField(**col) for col in schema]
+        with open(file, mode='rb') as f:
+            self.client.load_table_from_file(f, tbl, job_config=self.bigquery.LoadJobConfig(field_delimiter=delimiter, schema=schema)).result()
+
+
+class LazyClient():
+    # Stands in for a client attribute of a backend (e.g. BigQueryBackend.client) & connects on first use,
+    # so src can export bqclient & gcsclient to `from src import *` without authenticating at import.
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):  # e.g. copy & pickle probing an instance without backend set yet
+            raise AttributeError(attr)
+        return getattr(getattr(self.__dict__['backend'], self.__dict__['name']), attr)
+
+
+class DuckDBBackend():
+    # Table project.dataset.table is the Parquet file root/project/dataset/table.parquet.
+    # Queries are written in BigQuery SQL; translate rewrites them for DuckDB before they run.
+    # Loads append like BigQuery's write_append: the table's file is rewritten with the new rows & renamed into place.
+    # A DuckDB connection must not be used from two threads at once or across fork, so sql serializes calls & reconnects in new processes.
+    # duckdb is an optional dependency (pip install duckdb), imported only when this backend first connects.
+    # The spatial extension is loaded only for queries that call st_* functions or return geography columns.  DuckDB downloads it
+    # on first install, so for offline use install it beforehand on a machine with network access (python -c "import duckdb; duckdb.sql('install spatial')")
+    # or copy it into ~/.duckdb/extensions.
+    Types = {'string': 'varchar', 'integer': 'bigint', 'float': 'double', 'numeric': 'double', 'boolean': 'boolean'}
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self.lock = threading.RLock()
+        self.pid = None
+        self.spatial = False
+
+
+    def sql(self, query):
+        with self.lock:
+            if self.pid != os.getpid():
+                import duckdb
+                self.duckdb = duckdb
+                self.con = duckdb.connect()
+                self.pid = os.getpid()
+                self.spatial = False
+            if not self.spatial and re.search(r'\bst_\w+\s*\(', query, flags=re.I):
+                self.load_spatial()
+            return self.con.sql(query)
+
+
+    def load_spatial(self):
+        # load the spatial extension into this process's connection, installing it first if it is not cached locally
+        try:
+            self.con.sql('load spatial')
+        except self.duckdb.Error:
+            try:
+                self.con.sql('install spatial; load spatial')
+            except self.duckdb.Error as e:
+                raise Exception(f'DuckDB spatial extension could not be loaded ({e}) - it must be preinstalled for offline use: '
+                                f'run python -c "import duckdb; duckdb.sql(\'install spatial\')" once with network access') from e
+        self.spatial = True
+
+
+    def path(self, tbl):
+        return self.root.joinpath(*tbl.replace('`', '').replace(':', '.').split('.')).with_suffix('.parquet')
+
+
+    def ref(self, tbl):
+        # what a table name becomes in DuckDB SQL
+        path = self.path(tbl)
+        if not path.exists():
+            raise Exception(f'table {tbl} not found at {path}')
+        return f"read_parquet('{path}')"
+
+
+    def query(self, query):
+        with self.lock:
+            rel = self.sql(translate(query, self.ref))
+            if rel is None:
+                return True
+            # geography columns come back as WKT strings, as from BigQuery's to_dataframe
+            geo = [str(t).startswith('GEOMETRY') for t in rel.types]
+            if any(geo) and not self.spatial:
+                self.load_spatial()
+            cols = [f'st_astext("{c}") as "{c}"' if g else f'"{c}"' for c, g in zip(rel.columns, geo)]
+            return rel.project(', '.join(cols)).df()
+
+
+    def exists(self, tbl):
+        return self.path(tbl).exists()
+
+
+    def columns(self, tbl):
+        return self.sql(f'select * from {self.ref(tbl)} limit 0').columns
+
+
+    def modified(self, tbl):
+        try:
+            return self.path(tbl).stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+
+    def delete(self, tbl):
+        self.path(tbl).unlink(missing_ok=True)
+
+
+    def create_dataset(self, dataset):
+        self.root.joinpath(*dataset.split('.')).mkdir(parents=True, exist_ok=True)
+
+
+    def list_tables(self, dataset):
+        return sorted(f'{dataset}.{p.stem}' for p in self.root.joinpath(*dataset.split('.')).glob('*.parquet'))
+
+
+    def describe(self, dataset):
+        return {tbl: {'columns': list(self.columns(tbl)), 'modified': self.modified(tbl)} for tbl in self.list_tables(dataset)}
+
+
+    def write(self, tbl, select):
+        # append the rows of DuckDB query select to tbl
+        path = self.path(tbl)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            select = f"select * from read_parquet('{path}') union all by name select * from ({select})"
+        tmp = path.with_name(path.name + '.tmp')
+        self.sql(f"copy ({select}) to '{tmp}' (format parquet)")
+        os.replace(tmp, path)
+
+
+    def load(self, tbl, df=None, query=None, file=None):
+        if df is not None:
+            with self.lock:
+                self.sql('select 1')  # connect
+                self.con.register('load_df', df)
+                try:
+                    self.write(tbl, 'select * from load_df')
+                finally:
+                    self.con.unregister('load_df')
+        elif query is not None:
+            self.write(tbl, translate(query, self.ref))
+        elif file is not None:
+            self.write(tbl, f"select * from read_csv_auto('{file}')")
+
+
+    def load_file(self, tbl, file, delimiter, schema):
+        cols = ', '.join(f"'{c['name']}': '{self.Types[c['field_type'].lower()]}'" for c in schema)
+        self.write(tbl, f"select * from read_csv('{file}', delim='{delimiter}', header=false, columns={{{cols}}})")
+
+
+################# BigQuery SQL -> DuckDB SQL #################
+# Covers the dialect this package generates (Data.aggegrate, Space.get_nodes, MCMC.post_process, ...):
+#     project.dataset.table names     -> ref(name), e.g. read_parquet('...')
+#     "double quoted" strings         -> 'single quoted' strings (double quotes are identifiers in DuckDB)
+#     * except (...)                  -> * exclude (...)
+#     float64, int64, string types    -> double, bigint, varchar
+#     st_geogfrom* constructors       -> st_geomfrom* (make_valid => true becomes st_makevalid)
+#     st_perimeter, st_area, st_length, st_distance  -> spheroid versions in meters (DuckDB wants lat/lon order, hence st_flipcoordinates;
+#                                     st_distance is between points, such as the centroids Space.get_graph uses)
+#     st_simplify tolerance           -> meters to degrees (about 111km per degree)
+# Trailing commas, ignore nulls, qualify, & the other functions used here already work in DuckDB.
+bq_table_name = re.compile(r'(?<![\w.])([A-Za-z][\w-]*\.[A-Za-z_]\w*\.[A-Za-z_]\w*)(?![\w.(])')
+bq_tokens = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)")
+
+def flip_coordinates(g):
+    return f'st_flipcoordinates({g})'
+
+Geo_calls = {
+    'st_geogfromgeojson': lambda a: f'st_makevalid(st_geomfromgeojson({a[0]}))' if any('make_valid' in x.lower() and 'true' in x.lower() for x in a[1:]) else f'st_geomfromgeojson({a[0]})',
+    'st_geogfromtext'   : lambda a: f'st_geomfromtext({a[0]})',
+    'st_geogfromwkb'    : lambda a: f'st_geomfromwkb({a[0]})',
+    'st_geogfrom'       : lambda a: f'st_geomfromwkb({a[0]})',
+    'st_geogpoint'      : lambda a: f'st_point({a[0]}, {a[1]})',
+    'st_perimeter'      : lambda a: f'st_perimeter_spheroid({flip_coordinates(a[0])})',
+    'st_area'           : lambda a: f'st_area_spheroid({flip_coordinates(a[0])})',
+    'st_length'         : lambda a: f'st_length_spheroid({flip_coordinates(a[0])})',
+    'st_distance'       : lambda a: f'st_distance_spheroid(st_point2d(st_y({a[0]}), st_x({a[0]})), st_point2d(st_y({a[1]}), st_x({a[1]})))',
+    'st_simplify'       : lambda a: f'st_simplify({a[0]}, ({a[1]}) / 111320.0)',
+}
+
+def split_sql_args(s):
+    # split s at commas outside parentheses
+    args, depth, start = list(), 0, 0
+    for i, c in enumerate(s):
+        depth += (c == '(') - (c == ')')
+        if c == ',' and depth == 0:
+            args.append(s[start:i].strip())
+            start = i + 1
+    args.append(s[start:].strip())
+    return args
+
+
+def rewrite_geo_calls(sql):
+    # apply Geo_calls to every call in sql, innermost arguments first
+    pattern = re.compile(r'\b(' + '|'.join(Geo_calls) + r')\s*\(', re.IGNORECASE)
+    out, pos = list(), 0
+    for m in pattern.finditer(sql):
+        if m.start() < pos:  # inside a call already rewritten
+            continue
+        depth, i = 1, m.end()
+        while depth > 0:
+            depth += (sql[i] == '(') - (sql[i] == ')')
+            i += 1
+        args = [rewrite_geo_calls(a) for a in split_sql_args(sql[m.end():i-1])]
+        out.append(sql[pos:m.start()])
+        out.append(Geo_calls[m.group(1).lower()](args))
+        pos = i
+    out.append(sql[pos:])
+    return ''.join(out)
+
+
+def translate(sql, ref):
+    # BigQuery SQL -> DuckDB SQL, with every table name replaced by ref(name)
+    parts = bq_tokens.split(sql)
+    for k, p in enumerate(parts):
+        if k % 2 == 1:  # a quoted token
+            if p[0] == '"':
+                parts[k] = "'" + p[1:-1].replace("'", "''").replace('\\"', '"') + "'"
+            elif p[0] == '`':
+                parts[k] = ref(p[1:-1]) if p.count('.') == 2 else f'"{p[1:-1]}"'
+            continue
+        p = bq_table_name.sub(lambda m: ref(m.group(1)), p)
+        p = re.sub(r'\*\s*except\s*\(', '* exclude (', p, flags=re.IGNORECASE)
+        p = re.sub(r'\bfloat64\b', 'double', p, flags=re.IGNORECASE)
+        p = re.sub(r'\bint64\b', 'bigint', p, flags=re.IGNORECASE)
+        p = re.sub(r'\bas\s+string\b', 'as varchar', p, flags=re.IGNORECASE)
+        parts[k] = p
+    return rewrite_geo_calls(''.join(parts))
+
+
+def get_backend(name=None, root=None):
+    # backend named by name or the environment variable REDISTRICTING_BACKEND ('bigquery' or 'duckdb'; default bigquery).
+    # DuckDB tables live under REDISTRICTING_DUCKDB_ROOT if set, else root.
+    name = (name or os.getenv('REDISTRICTING_BACKEND', 'bigquery')).lower()
+    if name == 'bigquery':
+        return BigQueryBackend()
+    elif name == 'duckdb':
+        return DuckDBBackend(os.getenv('REDISTRICTING_DUCKDB_ROOT', root))
+    raise Exception(f'backend must be "bigquery" or "duckdb" ... got {name}')
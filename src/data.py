@@ -1,10 +1,5 @@
 from . import *
-import urllib, zipfile as zf, shapely.ops
-try:
-    import mechanicalsoup
-except:
-    os.system('pip install --upgrade mechanicalsoup')
-    import mechanicalsoup
+import urllib, zipfile as zf
 
 @dataclasses.dataclass
 class Data(Base):
@@ -12,10 +7,12 @@ class Data(Base):
         "office='USSen' and race='general'",
         "office='President' and race='general'",
         "office like 'USRep%' and race='general'")
+    source_workers    : int = 8
         
     def __post_init__(self):
         super().__post_init__()
-        self.sources = ('crosswalks', 'assignments', 'shapes', 'census', 'elections', 'countries', 'proposals', 'joined', 'tabblock', 'bg', 'tract', 'cntyvtd', 'cnty', 'all')
+        self.inputs = self.source_inputs()
+        self.sources = tuple(self.inputs)
         self.check_inputs()
 
         self.tbls = dict()
@@ -24,7 +21,7 @@ class Data(Base):
         self.path = dict()
         stem = f'{self.state.abbr}_{self.census_yr}'
         dataset = f'{root_bq}.redistricting_data'
-        bqclient.create_dataset(dataset, exists_ok=True)
+        create_dataset(dataset)
         for src in self.sources:
             self.path[src] = data_path / f'{src}/{stem.replace("_", "/")}'
             self.tbls[src] = f'{dataset}.{stem}_{src}'
@@ -32,8 +29,22 @@ class Data(Base):
             self.pq  [src] = self.zp[src].with_suffix('.parquet')
         self.tbls['countries'] = f'{dataset}.countries'
 
-        for src in self.sources:
-            self.get(src)
+        self.get_sources(self.inputs, workers=self.source_workers)
+
+
+    def source_inputs(self):
+        # the sources each source reads - downloads start together & the levels aggregate in parallel
+        return {'crosswalks' : (),
+                'assignments': (),
+                'shapes'     : (),
+                'census'     : ('assignments', 'crosswalks') if self.census_yr != self.shapes_yr else ('assignments',),
+                'elections'  : ('assignments', 'census'),
+                'countries'  : (),
+                'proposals'  : (),
+                'joined'     : ('assignments', 'census', 'elections', 'shapes'),
+                **{level: ('joined',) for level in self.Levels},
+                'all'        : self.Levels,
+               }
             
 #####################################################################################################
 #####################################################################################################
@@ -83,6 +94,11 @@ order by
         self.proposals = list()
         
         # self.proposals_dict = {dt:list() for dt in self.District_types.values()}
+        try:
+            import mechanicalsoup
+        except:
+            os.system('pip install --upgrade mechanicalsoup')
+            import mechanicalsoup
         browser = mechanicalsoup.Browser()
         for abbr, district_type in self.District_types.items():
             rpt(f'fetching {district_type}')
@@ -104,18 +120,16 @@ order by
                             fn = url.split('/')[-1]
                             zp = proposal_path / fn
                             if not zp.is_file():
-                                print(f'downloading {proposal}')
-                                os.chdir(proposal_path)
+                                rpt(f'downloading {proposal}')
                                 urllib.request.urlretrieve(url, zp)
-                                os.system("unzip -u '*.zip' >/dev/null 2>&1");
-                                os.system("unzip -u '*.zip' >/dev/null 2>&1");
+                                os.system(f"cd '{proposal_path}' && unzip -u '*.zip' >/dev/null 2>&1");
+                                os.system(f"cd '{proposal_path}' && unzip -u '*.zip' >/dev/null 2>&1");
                                 new += 1
-                                os.chdir(code_path)
                     csv = proposal_path / f'{proposal.upper()}.csv'
                     df = pd.read_csv(csv, skiprows=1, names=('geoid', district_type), dtype={'geoid':str})
                     seats = df[district_type].nunique()
                     complete = (seats == self.Seats[district_type]) or (k == 0)
-                    print(proposal, seats, complete)
+                    rpt(f'{proposal} {seats} {complete}', end='\n')
                     self.proposals.append({'district_type':district_type, 'proposal':proposal, 'k':k, 'complete':complete, 'csv':str(csv)})
                 if not_found > 15:
                     break
@@ -135,7 +149,6 @@ order by
             zipfile = False
         except:
             self.path[src].mkdir(parents=True, exist_ok=True)
-            os.chdir(self.path[src])
             try:
                 zipfile = zf.ZipFile(self.zp[src])
                 rpt(f'using existing zip')
@@ -151,7 +164,6 @@ order by
 #####################################################################################################
     
     def get_joined(self):
-        self.refresh_tbl.update(self.Levels)
         src = 'joined'
         cols = {'A' : self.District_types.values(),
                 'C' : ['seats_cd', 'seats_sldu', 'seats_sldl', 'total_pop_prop'] + Census_columns['data'],
@@ -355,13 +367,12 @@ on
 
         if show:
             for k, q in enumerate(query):
-                print(f'\n=====================================================================================\nstage {k}')
-                print(q)
+                rpt(f'\n=====================================================================================\nstage {k}', end='\n')
+                rpt(q, end='\n')
         return query[-1]
             
     
     def aggegrate_level(self, level, show=False):
-        self.refresh_tbl.add('all')
         query = f"""
 select
     *,
@@ -390,7 +401,6 @@ from
 #####################################################################################################
 
     def get_elections(self):
-        self.refresh_tbl.add('joined')
         src = 'elections'
         url = f'https://data.capitol.texas.gov/dataset/aab5e1e5-d585-4542-9ae8-1108f45fce5b/resource/253f5191-73f3-493a-9be3-9e8ba65053a2/download/{self.census_yr}-general-vtd-election-data.zip'
         zipfile = self.fetch(src, url)
@@ -543,7 +553,6 @@ on
 #         os.system(cmd)
 
     def get_census(self):
-        self.refresh_tbl.add('joined')
         src = 'census'
         url = f'https://www2.census.gov/programs-surveys/decennial/{self.census_yr}/data/01-Redistricting_File--PL_94-171/{self.state.name.replace(" ", "_")}/{self.state.abbr.lower()}{self.census_yr}.pl.zip'
         zipfile = self.fetch(src, url)
@@ -568,10 +577,9 @@ on
                         rpt(f'using existing raw {i} table')
                     else:
                         rpt(f'processing {fn}')
-                        file = zipfile.extract(fn)
-                        schema = [google.cloud.bigquery.SchemaField(**col) for col in Census_columns[i]]
-                        with open(file, mode='rb') as f:
-                            bqclient.load_table_from_file(f, temp[i], job_config=google.cloud.bigquery.LoadJobConfig(field_delimiter='|', schema=schema)).result()
+                        file = zipfile.extract(fn, self.path[src])
+                        backend.load_file(temp[i], file, delimiter='|', schema=Census_columns[i])
+                        manifest.update(temp[i])
         #                 os.unlink(fn)
 
 ######## combine census tables into one table ########
@@ -670,7 +678,6 @@ order by
 #####################################################################################################
     
     def get_shapes(self):
-        self.refresh_tbl.add('joined')
         src = 'shapes'
         url = f'https://www2.census.gov/geo/tiger/TIGER{self.shapes_yr}/TABBLOCK'
         if self.shapes_yr == 2010:
@@ -687,8 +694,9 @@ order by
             rpt(f'using existing raw table')
         else:
             rpt(f'creating raw table')
+            import geopandas as gpd, shapely.ops
             for fn in zipfile.namelist():
-                zipfile.extract(fn)
+                zipfile.extract(fn, self.path[src])
             a = 0
             chunk_size = 50000
             while True:
@@ -724,7 +732,6 @@ order by
 #####################################################################################################
     
     def get_assignments(self):
-        self.refresh_tbl.add('joined')
         src = 'assignments'
         url = f'https://www2.census.gov/geo/docs/maps-data/data/baf'
         if self.census_yr == 2020:
@@ -760,7 +767,6 @@ order by
 #####################################################################################################
     
     def get_crosswalks(self):
-        self.refresh_tbl.add('joined')
         src = 'crosswalks'
         url = f'https://www2.census.gov/geo/docs/maps-data/data/rel2020/t10t20/TAB2010_TAB2020_ST{self.state.fips}.zip'
         zipfile = self.fetch(src, url)
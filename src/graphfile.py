@@ -0,0 +1,94 @@
+from . import *
+
+################# Compact graph files #################
+# The graph built by Space.get_graph, saved as a directory of .npy arrays instead of a networkx gpickle:
+#     meta.json                  format version, node & edge counts, & attribute names
+#     geoids.npy                 sorted geoids as fixed width bytes - node i is geoids[i]
+#     indptr.npy, indices.npy    CSR adjacency with both directions of every edge & each node's neighbors sorted (as in PartitionState)
+#     node_<attr>.npy            one column per node attribute, aligned with geoids (strings as fixed width bytes)
+#     edge_<attr>.npy            one column per edge attribute, aligned with indices
+# CompactGraph maps every array with np.load(mmap_mode='r'), so processes on one machine share the page cache
+# rather than each unpickling millions of Python objects.  to_networkx rebuilds the networkx graph for code that still needs it.
+graph_format = 1
+
+def encode_column(x):
+    # numpy column for x, with strings as fixed width bytes so the file can be memory-mapped
+    x = np.asarray(x)
+    if x.dtype.kind in 'UO':
+        x = np.char.encode(x.astype(str), 'utf-8')
+    return x
+
+
+def decode_column(x):
+    return np.char.decode(x, 'utf-8') if x.dtype.kind == 'S' else x
+
+
+def write_graph(path, G):
+    # Save networkx graph G as a compact graph directory at path.
+    # Arrays are written to a temporary directory that is renamed into place, so readers never see a partial graph.
+    path = pathlib.Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    geoids = sorted(G.nodes)
+    index = {g: i for i, g in enumerate(geoids)}
+    node_attr = sorted(set().union(*(d.keys() for g, d in G.nodes(data=True))))
+    edge_attr = sorted(set().union(*(d.keys() for u, v, d in G.edges(data=True))))
+    E = [(index[u], index[v], d) for u, v, d in G.edges(data=True)]
+    src = np.array([e[0] for e in E] + [e[1] for e in E], dtype=np.int64)  # store both directions
+    dst = np.array([e[1] for e in E] + [e[0] for e in E], dtype=np.int64)
+    order = np.lexsort((dst, src))
+    indptr = np.zeros(len(geoids)+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(src, minlength=len(geoids)))
+    np.save(tmp / 'geoids.npy', encode_column(geoids))
+    np.save(tmp / 'indptr.npy', indptr)
+    np.save(tmp / 'indices.npy', dst[order])
+    for a in node_attr:
+        np.save(tmp / f'node_{a}.npy', encode_column([G.nodes[g].get(a) for g in geoids]))
+    for a in edge_attr:
+        col = encode_column([e[2].get(a) for e in E])
+        np.save(tmp / f'edge_{a}.npy', np.concatenate([col, col])[order])
+    meta = {'version': graph_format, 'nodes': len(geoids), 'edges': len(E), 'node_attr': node_attr, 'edge_attr': edge_attr}
+    with open(tmp / 'meta.json', 'w') as f:
+        json.dump(meta, f, indent=4)
+    shutil.rmtree(path, ignore_errors=True)
+    tmp.rename(path)
+
+
+class CompactGraph():
+    # Read-only graph backed by the arrays of a compact graph directory (see write_graph).
+    # With mmap=False every array is read into memory instead.
+    def __init__(self, path, mmap=True):
+        self.path = pathlib.Path(path)
+        with open(self.path / 'meta.json', 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != graph_format:
+            raise Exception(f'{self.path} has graph format {self.meta["version"]} ... expected {graph_format}')
+        load = lambda name: np.load(self.path / f'{name}.npy', mmap_mode='r' if mmap else None)
+        self.geoids  = load('geoids')
+        self.indptr  = load('indptr')
+        self.indices = load('indices')
+        self.node = {a: load(f'node_{a}') for a in self.meta['node_attr']}
+        self.edge = {a: load(f'edge_{a}') for a in self.meta['edge_attr']}
+
+
+    def number_of_nodes(self):
+        return self.meta['nodes']
+
+
+    def number_of_edges(self):
+        return self.meta['edges']
+
+
+    def to_networkx(self):
+        # the networkx graph write_graph was given (node & edge attributes as Python scalars)
+        geoids = decode_column(self.geoids).tolist()
+        node = {a: decode_column(x).tolist() for a, x in self.node.items()}
+        src = np.repeat(np.arange(len(geoids)), np.diff(self.indptr))
+        upper = np.flatnonzero(src < self.indices)  # each edge once
+        edge = {a: decode_column(x[upper]).tolist() for a, x in self.edge.items()}
+        G = nx.Graph()
+        G.add_nodes_from((g, {a: x[i] for a, x in node.items()}) for i, g in enumerate(geoids))
+        G.add_edges_from((geoids[u], geoids[v], {a: x[k] for a, x in edge.items()})
+                         for k, (u, v) in enumerate(zip(src[upper].tolist(), self.indices[upper].tolist())))
+        return G
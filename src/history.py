@@ -0,0 +1,117 @@
+from . import *
+import bisect
+
+class PlanHistory():
+    # Every plan of a chain stored as the initial assignment plus, for each step, the nodes that changed & their new districts.
+    # Node & district indices use the smallest unsigned integer type that holds them.
+    # A full assignment (keyframe) is kept every keyframe_period plans, so get(plan) replays at most keyframe_period deltas.
+    def __init__(self, assignment, n_districts, keyframe_period=100):
+        self.n = len(assignment)
+        self.keyframe_period = keyframe_period
+        self.node_dtype     = np.min_scalar_type(max(self.n - 1, 0))
+        self.district_dtype = np.min_scalar_type(max(n_districts - 1, 0))
+        self.current = np.asarray(assignment).astype(self.district_dtype)
+        self.plans = [0]
+        self.ptr   = [0, 0]  # deltas of plans[i] are nodes[ptr[i]:ptr[i+1]] & districts[ptr[i]:ptr[i+1]] (none at plan 0)
+        self.nodes     = np.zeros(1024, dtype=self.node_dtype)
+        self.districts = np.zeros(1024, dtype=self.district_dtype)
+        self.keyframes = {0: self.current.copy()}
+
+
+    def append(self, plan, assignment):
+        # record assignment as plan (plans must increase); returns the nodes that changed since the previous plan
+        assert plan > self.plans[-1], f'plan {plan} recorded after plan {self.plans[-1]}'
+        changed = np.flatnonzero(self.current != assignment)
+        self.current[changed] = assignment[changed]
+        m = self.ptr[-1]
+        if m + len(changed) > len(self.nodes):  # grow geometrically
+            size = max(2 * len(self.nodes), m + len(changed))
+            self.nodes     = np.resize(self.nodes    , size)
+            self.districts = np.resize(self.districts, size)
+        self.nodes    [m:m+len(changed)] = changed
+        self.districts[m:m+len(changed)] = self.current[changed]
+        self.plans.append(plan)
+        self.ptr.append(m + len(changed))
+        if (len(self.plans) - 1) % self.keyframe_period == 0:
+            self.keyframes[plan] = self.current.copy()
+        return changed
+
+
+    def delta(self, plan):
+        # (nodes, districts) that changed at plan (the latest recorded plan <= plan)
+        i = self.find(plan)
+        return self.nodes[self.ptr[i]:self.ptr[i+1]], self.districts[self.ptr[i]:self.ptr[i+1]]
+
+
+    def find(self, plan):
+        # position in plans of the latest recorded plan <= plan
+        i = bisect.bisect_right(self.plans, plan) - 1
+        assert i >= 0, f'plan {plan} precedes this history'
+        return i
+
+
+    def get(self, plan):
+        # district index of every node at plan (the latest recorded plan <= plan)
+        i = self.find(plan)
+        key = max(p for p in self.keyframes if p <= self.plans[i])
+        assignment = self.keyframes[key].astype(np.int64)
+        j = self.find(key)
+        a, b = self.ptr[j+1], self.ptr[i+1]
+        assignment[self.nodes[a:b]] = self.districts[a:b]  # later deltas overwrite earlier ones
+        return assignment
+
+
+    def state(self):
+        # flat arrays for MCMC.snapshot & checkpoints; from_state rebuilds the history exactly
+        keys = sorted(self.keyframes)
+        m = self.ptr[-1]
+        return {'plans': np.array(self.plans, dtype=np.int64), 'ptr': np.array(self.ptr, dtype=np.int64),
+                'nodes': self.nodes[:m].copy(), 'districts': self.districts[:m].copy(), 'current': self.current.copy(),
+                'keyframe_plans': np.array(keys, dtype=np.int64), 'keyframes': np.stack([self.keyframes[p] for p in keys]),
+                'keyframe_period': self.keyframe_period}
+
+
+    @classmethod
+    def from_state(cls, state):
+        H = cls.__new__(cls)
+        H.n = len(state['current'])
+        H.keyframe_period = int(state['keyframe_period'])
+        H.node_dtype = state['nodes'].dtype
+        H.district_dtype = state['current'].dtype
+        H.current = state['current'].copy()
+        H.plans = state['plans'].tolist()
+        H.ptr = state['ptr'].tolist()
+        H.nodes = state['nodes'].copy()
+        H.districts = state['districts'].copy()
+        H.keyframes = {p: x.copy() for p, x in zip(state['keyframe_plans'].tolist(), state['keyframes'])}
+        return H
+
+
+def expand_plan_query(plan_tbl, summary_tbl):
+    # SQL for full plans (1 row per random_seed, plan, & geoid) from a delta-encoded plan table,
+    # which holds every node at plan 0 but only the nodes that changed district at later plans - see MCMC.record.
+    # summary_tbl supplies the list of plans.  Each node takes its most recent district at or before each plan.
+    return f"""
+select
+    G.random_seed,
+    G.plan,
+    G.geoid,
+    last_value(P.district ignore nulls) over (partition by G.random_seed, G.geoid order by G.plan asc) as district,
+from (
+    select
+        S.random_seed,
+        S.plan,
+        N.geoid,
+    from
+        {summary_tbl} as S
+    inner join (
+        select distinct random_seed, geoid from {plan_tbl} where plan = 0
+        ) as N
+    on
+        N.random_seed = S.random_seed
+    ) as G
+left join
+    {plan_tbl} as P
+on
+    P.random_seed = G.random_seed and P.plan = G.plan and P.geoid = G.geoid
+"""
@@ -0,0 +1,115 @@
+from .backends import *
+import json, fcntl
+
+################# Table manifest #################
+# Local record of which tables exist, with their columns & last-modified times, kept as one json file per dataset:
+#     root/<project>.<dataset>.json     {table: {'columns': [...], 'modified': ...}, ...}
+# check_table, get_cols, & list_tables in __init__.py answer from it, so constructing Data, Space, or MCMC makes no per-table
+# metadata calls - launching many chain workers at once no longer means thousands of get_table round-trips.
+# A dataset is listed with one bulk call (backend.describe) the first time it is needed, and again whenever Base.delete_for_refresh
+# handles a source in refresh_tbl or refresh_all.  load_table & delete_table update their table's entry as they go.
+# Every process re-reads a file when it changes on disk, so tables made by one worker are seen by the rest.
+# Tables created or dropped outside these helpers (e.g. DDL through run_query or the console) are not seen until the next refresh.
+
+class TableManifest():
+    def __init__(self, backend, root):
+        self.backend = backend
+        self.root = pathlib.Path(root)
+        self.lock = threading.RLock()
+        self.loaded = dict()  # dataset -> (file mtime, tables) as last read in this process
+
+
+    @staticmethod
+    def split(tbl):
+        # project.dataset.table -> (project.dataset, table)
+        dataset, name = tbl.replace('`', '').replace(':', '.').rsplit('.', 1)
+        return dataset, name
+
+
+    def path(self, dataset):
+        return self.root / f'{dataset}.json'
+
+
+    def read(self, dataset):
+        # tables in dataset as last saved by any process, or None if dataset has never been listed
+        path = self.path(dataset)
+        with self.lock:
+            try:
+                mtime = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                return None
+            if dataset in self.loaded and self.loaded[dataset][0] == mtime:
+                return self.loaded[dataset][1]
+            with open(path, 'r') as f:
+                tables = json.load(f)
+            self.loaded[dataset] = (mtime, tables)
+            return tables
+
+
+    def write(self, dataset, change):
+        # Apply change to the saved tables of dataset & save, holding a file lock so concurrent workers do not lose each other's updates.
+        # change does its backend calls under the lock too, so a listing can never be saved over a newer update.
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self.lock, open(self.root / f'{dataset}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            tables = change(dict(self.read(dataset) or dict()))
+            tmp = self.path(dataset).with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(tables, f)
+            os.replace(tmp, self.path(dataset))
+            self.loaded.pop(dataset, None)
+            return tables
+
+
+    def refresh(self, dataset):
+        # relist dataset with one bulk call
+        return self.write(dataset, lambda tables: {self.split(tbl)[1]: info for tbl, info in self.backend.describe(dataset).items()})
+
+
+    def tables(self, dataset):
+        tables = self.read(dataset)
+        return self.refresh(dataset) if tables is None else tables
+
+
+    def update(self, tbl):
+        # re-read one table after this process created, changed, or deleted it
+        dataset, name = self.split(tbl)
+        def change(tables):
+            if self.backend.exists(tbl):
+                tables[name] = {'columns': list(self.backend.columns(tbl)), 'modified': self.backend.modified(tbl)}
+            else:
+                tables.pop(name, None)
+            return tables
+        if self.read(dataset) is None:  # never listed - list it all now rather than saving a partial dataset
+            self.refresh(dataset)
+        else:
+            self.write(dataset, change)
+
+
+    def exists(self, tbl):
+        dataset, name = self.split(tbl)
+        return name in self.tables(dataset)
+
+
+    def columns(self, tbl):
+        dataset, name = self.split(tbl)
+        try:
+            return self.tables(dataset)[name]['columns']
+        except KeyError:
+            raise Exception(f'table {tbl} not found')
+
+
+    def modified(self, tbl):
+        dataset, name = self.split(tbl)
+        return self.tables(dataset).get(name, dict()).get('modified')
+
+
+    def names(self, dataset):
+        return sorted(f'{dataset}.{name}' for name in self.tables(dataset))
+
+
+    def clear(self):
+        with self.lock:
+            for p in self.root.glob('*.json'):
+                p.unlink(missing_ok=True)
+            self.loaded.clear()
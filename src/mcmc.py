@@ -1,41 +1,122 @@
 from .space import *
+from .partition import *
+from .recom import *
+from .history import *
+from .sink import *
+from .records import *
+
+# Hot path instrumentation: wall time per phase & event counts, recorded per step with the summary records (see MCMC.tick)
+phases   = ('pairs', 'trees', 'cuts', 'checks', 'accept', 'record', 'save')
+counters = ('pairs', 'pairs_infeasible', 'pairs_exhausted', 'trees', 'trees_repeat', 'trees_no_cut', 'edges', 'rej_defect', 'rej_yolo')
+instruments = [(f'time_{p}', np.float64) for p in phases] + [(f'n_{c}', np.int64) for c in counters]
 
 @dataclasses.dataclass
 class MCMC(Space):
     random_seed          : int = 0
     max_steps            : int = 10
     report_period        : int = 1
-    save_period          : int = 500
+    save_period          : int = 500   # save results every this many steps (0 = only when run_chain returns)
     pop_deviation_target : float = np.inf
     yolo_length          : int = 10
     defect_cap           : int = np.inf
+    boundary_exp         : float = 0
+    checkpoint_period    : int = 0     # write a checkpoint every this many steps (0 = never) - see save_checkpoint
+    keyframe_period      : int = 100   # store a full plan every this many steps in self.history - see history.py
+    uploader             : typing.Any = 'bigquery'  # where save_results forwards records after writing them locally: 'bigquery', None, or callable(src, df, overwrite)
+    resume               : str = None  # checkpoint file to continue from
         
     
     def __post_init__(self):
         super().__post_init__()
         self.sources = ('plan', 'county', 'district', 'summary', 'hash')
         self.check_inputs()
-        
-        self.random_seed = int(self.random_seed)
-        self.rng = np.random.default_rng(self.random_seed)
 
         self.stem = f'{self.state.abbr}_{self.census_yr}_{self.district_type}_{self.proposal}'
         self.dataset = f'{root_bq}.{self.stem}'
-        bqclient.create_dataset(self.dataset, exists_ok=True)
-        self.recs = dict()
+        create_dataset(self.dataset)
+        self.setup()
+
+
+    @classmethod
+    def offline(cls, graph, district_type='cd', **opts):
+        # A chain on graph (e.g. from synthetic.py) that skips the Data & Space setup, so nothing reads or writes BigQuery.
+        # For benchmarks: drive it with recomb & record, since run_chain still saves & post-processes to the warehouse.
+        opts.setdefault('uploader', None)  # results stay local unless the caller supplies an uploader
+        M = cls.__new__(cls)
+        for f in dataclasses.fields(cls):
+            M[f.name] = opts.pop(f.name) if f.name in opts else f.default if f.default is not dataclasses.MISSING else f.default_factory()
+        if opts:
+            raise Exception(f'got unknown options {opts}')
+        M.graph = graph
+        M.district_type = district_type
+        M.state = pd.Series({'abbr': M.abbr})
+        M.sources = ('plan', 'county', 'district', 'summary', 'hash')
+        M.tbls, M.path = dict(), dict()
+        M.stem = f'{M.abbr}_{M.census_yr}_{district_type}_{M.proposal}'
+        M.dataset = f'{root_bq}.{M.stem}'
+        M.setup()
+        return M
+
+
+    def setup(self):
+        # The chain runs entirely on self.partition; self.graph & self.adj are only refreshed by an explicit export()
+        self.partition  = PartitionState.from_graph(self.graph)
+        self.districts  = self.partition.districts.tolist()
+        self.counties   = self.partition.counties.tolist()
+        self.total_pop  = self.partition.total_pop.sum()
+        self.target_pop = self.partition.target_pop
+        # all district pairs (x < y) & the pairs each district belongs to - used to sample pairs in recomb
+        self.pair_index = np.column_stack(np.triu_indices(len(self.districts), 1))
+        self.district_pairs = [np.flatnonzero((self.pair_index == d).any(axis=1)) for d in range(len(self.districts))]
+        self.progress = None  # optional shared step counter (multiprocessing.Value) incremented by run_chain - see multichain.py
+        self.set_seed(self.random_seed)
+        self.get_adj()
+        if self.resume is not None:
+            self.load_checkpoint(self.resume)
+
+
+    def set_seed(self, random_seed):
+        # everything that depends on random_seed: rng, result tables, records, & the pair sampler
+        self.random_seed = int(random_seed)
+        self.rng = np.random.default_rng(self.random_seed)
         for src in self.sources:
-            self.recs[src] = list()
             self.path[src] = data_path / f'proposals/{self.stem.replace("_", "/")}'
             self.tbls[src] = f'{self.dataset}.{self.level}_{self.contract}_{self.random_seed}_{src}'
         self.output = f'{self.dataset}.{self.level}_{self.contract}_{self.random_seed}_all'
-            
-        self.districts  = sorted({d for x, d in self.graph.nodes(data='district')})
-        self.counties   = sorted({d for x, d in self.graph.nodes(data='county')})
-        self.total_pop  = sum(d for x, d in self.graph.nodes(data='total_pop'))
-        self.target_pop = self.total_pop / len(self.districts)
-        self.get_adj()
+        self.checkpoint = self.path['plan'] / f'{self.level}_{self.contract}_{self.random_seed}_checkpoint.npz'
+        self.results_path = self.path['plan'] / 'results'
+        # Columnar record buffers (see records.py) - node, county, & district columns hold indices into the partition
+        S = self.partition
+        i8, f8 = np.int64, np.float64
+        self.recs = {
+            'plan'    : RecordBuffer([('plan', i8), ('geoid', i8), ('district', i8)], {'geoid':S.geoids, 'district':S.districts}),
+            'county'  : RecordBuffer([('plan', i8), ('county', i8), ('whole_defect', i8), ('intersect_defect', i8), ('defect', i8)], {'county':S.counties}),
+            'district': RecordBuffer([('plan', i8), ('district', i8), ('total_pop', S.district_pop.dtype), ('pop_deviation', f8), ('polsby_popper', f8), ('aland', f8)], {'district':S.districts}),
+            'summary' : RecordBuffer([('plan', i8), ('hash', i8), ('polsby_popper', f8), ('pop_deviation', f8), ('intersect_defect', i8), ('whole_defect', i8), ('defect', i8)] + instruments),
+            'hash'    : list()}
+        self.step_stats = {a: 0 for a, t in instruments}  # since the last record
+        self.totals     = {a: 0 for a, t in instruments}  # whole chain
+        self.sink = None  # ResultSink started by the first save_results - threads are per process, so never shared by spawn
+        self.overwrite_tbl = True
+        self.history = None  # PlanHistory of every recorded plan, started when plan 0 is recorded
+        self.stats_version = None  # partition.version when update last ran
+        self.pop_diff_exp = None
         self.plan = 0
         self.update()
+
+
+    def spawn(self, random_seed, partition=None):
+        # A new chain with its own random_seed, rng, records, & partition that shares everything else (graph, options, tables) with self.
+        # Skips the Data & Space setup (BigQuery checks, graph load) that constructing MCMC repeats.
+        # partition defaults to a fresh copy of self.partition's current plan.
+        M = copy.copy(self)
+        M.path = self.path.copy()
+        M.tbls = self.tbls.copy()
+        if partition is None:
+            partition = PartitionState(**self.partition.static(), assignment=self.partition.assignment.copy())
+        M.partition = partition
+        M.set_seed(random_seed)
+        return M
             
             
     def post_process(self):
@@ -55,8 +136,9 @@ select
     {join_str(1).join([f'D.{c} as {c}_district' for c in district_cols])},
     {join_str(1).join([f'C.{c} as {c}_county'   for c in county_cols  ])},
     --N.* except (geoid, district, county),
-from
-    {self.tbls['plan']} as P
+from (
+    {subquery(expand_plan_query(self.tbls['plan'], self.tbls['summary']))}
+    ) as P
 left join
     {self.tbls['nodes']} as N
 on
@@ -78,219 +160,377 @@ on
         
         
     def save_results(self):
+        # Hand unsaved records to the background sink & carry on - writing Parquet & uploading happen off the chain's thread (see sink.py).
         self.report()
-        rpt('saving')
+        if self.sink is None:
+            uploader = BigQueryUploader(self.tbls) if self.uploader == 'bigquery' else self.uploader
+            self.sink = ResultSink(self.results_path, uploader)
         for src in self.recs.keys():
-            if src == 'hash':
+            if src == 'hash' or len(self.recs[src]) == 0:
                 continue
-            rpt(src)
-            saved = False
-            for i in range(1, 60):
-                try:
-                    load_table(tbl=self.tbls[src], df=pd.concat(self.recs[src], axis=0), overwrite=self.overwrite_tbl)
-                    self.recs[src] = list()
-                    saved = True
-                    break
-                except:
-                    time.sleep(5)
-            assert saved, f'I tried to write the result of random_seed {self.random_seed} {i} times without success - giving up'
+            self.sink.put(src, [self.recs[src].to_df(random_seed=self.random_seed)], overwrite=self.overwrite_tbl)
+            self.recs[src].clear()
         self.overwrite_tbl = False
-        print(f'done')
 
-    
-    def run_chain(self):
-        self.plan = 0
-        self.update()
-        self.overwrite_tbl = True
-        self.record()
+
+    def close_sink(self):
+        # wait for every saved record to be written & uploaded
+        if self.sink is not None:
+            rpt('waiting for results to upload')
+            if not self.sink.close():
+                print(f'random_seed {self.random_seed}: some results were not uploaded or written - see {self.results_path}/pending.json')
+            self.sink = None
+
+
+    def run_chain(self, steps=np.inf, time_budget=np.inf):
+        # Run from the current plan until max_steps, or until steps more steps or time_budget seconds have passed if sooner.
+        # A chain stopped early continues where it left off on the next call (or after load_snapshot in another process).
+        # Returns True once the chain is finished (max_steps reached or stuck) - only then is it post-processed.
+        if self.plan == 0:
+            self.update()
+            self.overwrite_tbl = True
+            self.record()
         self.start_time = time.time()
-        while self.plan < self.max_steps:
+        stop = min(self.max_steps, self.plan + steps)
+        stuck = False
+        while self.plan < stop and time.time() - self.start_time < time_budget:
             self.plan += 1
             msg = f"random_seed {self.random_seed} step {self.plan} pop_deviation={self.pop_deviation:.1f}"
             if self.recomb() is False:
                 rpt(msg)
+                stuck = True
                 break
             else:
+                # record & save time is charged to the NEXT step's summary record, since this one is written by record
+                t = time.perf_counter()
                 self.record()
-                if self.plan % self.save_period == 0:
+                t = self.tick('record', t)
+                if self.progress is not None:
+                    with self.progress.get_lock():
+                        self.progress.value += 1
+                saved = self.save_period > 0 and self.plan % self.save_period == 0
+                if saved:
                     self.save_results()
                 elif self.plan % self.report_period == 0:
                     self.report()
-        if self.plan % self.save_period != 0:
+                # also checkpoint right after every save, so resuming never starts before rows already uploaded & saves them twice
+                if self.checkpoint_period > 0 and (saved or self.plan % self.checkpoint_period == 0):
+                    self.save_checkpoint()
+                self.tick('save', t)
+        if len(self.recs['summary']) > 0:
             self.save_results()
         elif self.plan % self.report_period != 0:
             self.report()
+        self.close_sink()
+        if self.checkpoint_period > 0:  # so a stopped or finished chain can be continued or extended (raise max_steps & resume)
+            self.save_checkpoint()
+        if not stuck and self.plan < self.max_steps:
+            return False
         self.post_process()
         print(f'random_seed {self.random_seed} done')
+        return True
+
+
+    def snapshot(self):
+        # Everything needed to continue this chain exactly where it is, in this or another process (see load_snapshot).
+        # Includes records not yet saved but not what is shared by all chains (graph, options).
+        sampler = self.pop_diff_exp is not None
+        return {'random_seed'  : self.random_seed,
+                'plan'         : self.plan,
+                'overwrite_tbl': self.overwrite_tbl,
+                'partition'    : self.partition.state(),
+                'rng'          : self.rng.bit_generator.state,
+                'hash'         : self.recs['hash'][-self.yolo_length:],
+                'recs'         : {src: rec.state() for src, rec in self.recs.items() if src != 'hash'},
+                'pop_diff_exp' : self.pop_diff_exp,
+                'pairs'        : self.pairs.state() if sampler else None,
+                'infeasible'   : sorted(self.infeasible) if sampler else None,
+                'history'      : self.history.state() if self.history is not None else None,
+                'totals'       : dict(self.totals)}
+
+
+    def load_snapshot(self, snap):
+        # Continue the chain saved by snapshot: same plan, rng, yolo window, records, & pair sampler.
+        # The partition's floating point caches are restored exactly too, so the continuation matches an uninterrupted run bit for bit.
+        self.set_seed(snap['random_seed'])
+        self.partition.load_state(snap['partition'])
+        self.plan = snap['plan']
+        self.overwrite_tbl = snap['overwrite_tbl']
+        self.rng.bit_generator.state = snap['rng']
+        self.recs['hash'] = list(snap['hash'])
+        for src, rows in snap['recs'].items():
+            self.recs[src].load(rows)
+        self.pop_diff_exp = snap['pop_diff_exp']
+        if snap['pairs'] is not None:
+            self.pairs = FenwickSampler.from_state(snap['pairs'])
+            self.infeasible = set(snap['infeasible'])
+        if snap['history'] is not None:
+            self.history = PlanHistory.from_state(snap['history'])
+        self.totals.update(snap['totals'])
+        self.update()
+
+
+    def save_checkpoint(self, path=None):
+        # write snapshot to a compressed npz file (default self.checkpoint); MCMC(resume=path) continues from it
+        path = pathlib.Path(self.checkpoint if path is None else path)
+        if self.sink is not None:  # records saved before this checkpoint must be on disk before it is
+            self.sink.flush()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        snap = self.snapshot()
+        arrays = {'random_seed'  : snap['random_seed'],
+                  'plan'         : snap['plan'],
+                  'overwrite_tbl': snap['overwrite_tbl'],
+                  'rng'          : json.dumps(snap['rng']),
+                  'totals'       : json.dumps(snap['totals']),
+                  'hash'         : np.array(snap['hash'], dtype=np.int64),
+                  'pop_diff_exp' : -1 if snap['pop_diff_exp'] is None else snap['pop_diff_exp']}
+        arrays.update({f'partition/{a}': x for a, x in snap['partition'].items()})
+        if snap['pairs'] is not None:
+            arrays.update({f'pairs/{a}': x for a, x in snap['pairs'].items()})
+            arrays['infeasible'] = np.array(snap['infeasible'], dtype=np.int64)
+        if snap['history'] is not None:
+            arrays.update({f'history/{a}': x for a, x in snap['history'].items()})
+        arrays.update({f'recs/{src}': rows for src, rows in snap['recs'].items()})
+        tmp = path.with_suffix('.tmp.npz')
+        np.savez_compressed(tmp, **arrays)
+        os.replace(tmp, path)  # never leave a half written checkpoint behind
+        return path
+
+
+    def load_checkpoint(self, path):
+        with np.load(path) as f:
+            A = {a: f[a] for a in f.files}
+        group = lambda prefix: {a[len(prefix):]: x for a, x in A.items() if a.startswith(prefix)}
+        pairs = group('pairs/')
+        history = group('history/')
+        self.load_snapshot({'random_seed'  : int(A['random_seed']),
+                            'plan'         : int(A['plan']),
+                            'overwrite_tbl': bool(A['overwrite_tbl']),
+                            'partition'    : group('partition/'),
+                            'rng'          : json.loads(str(A['rng'])),
+                            'hash'         : A['hash'].tolist(),
+                            'recs'         : group('recs/'),
+                            'pop_diff_exp' : None if int(A['pop_diff_exp']) < 0 else int(A['pop_diff_exp']),
+                            'pairs'        : {'weights': pairs['weights'], 'tree': pairs['tree'], 'updates': int(pairs['updates'])} if pairs else None,
+                            'infeasible'   : A['infeasible'].tolist() if pairs else None,
+                            'history'      : history if history else None,
+                            'totals'       : json.loads(str(A['totals']))})
 
 
     def update(self):
-        for G in [self.graph, self.adj]:
-            for a in ['random_seed', 'plan']:
-                nx.set_node_attributes(G, self[a], a)
-        self.hash = get_hash(self.graph)
+        # Refresh the chain statistics from self.partition, but only if it changed since the last refresh
+        # (partition.version is the dirty flag), so each statistic is computed once per step however often update is called.
+        S = self.partition
+        if self.stats_version == S.version:
+            return
+        self.stats_version = S.version
+        self.hash = S.get_hash()
         self.get_county_stats()
         self.get_district_stats()
-        self.plan_df = graph_to_df(self.graph, 'geoid', attr=('random_seed', 'plan', 'district'))
-        H = self.adj.subgraph(self.counties)
-        self.county_df = graph_to_df(H, 'county', attr=('random_seed', 'plan', 'whole_defect', 'intersect_defect', 'defect'))
-        H = self.adj.subgraph(self.districts)
-        self.district_df =  graph_to_df(H, 'district', attr=('random_seed', 'plan', 'total_pop', 'pop_deviation', 'polsby_popper', 'aland'))
-        attr = ['random_seed', 'plan', 'hash', 'polsby_popper', 'pop_deviation', 'intersect_defect', 'whole_defect', 'defect']
-        self.summary_df = pd.DataFrame([{a:self[a] for a in attr}])
 
     
     def record(self):
         self.update()
-        for src, rec in self.recs.items():
-            if src == 'hash':
-                X = self.hash
-            else:
-                X = self[f'{src}_df'].copy()
-            rec.append(X)
+        # Plans are delta-encoded: every node at plan 0, then only the nodes that changed district.
+        # self.history keeps them all in memory for get_plan; expand_plan_query rebuilds full plans in the warehouse.
+        S = self.partition
+        if self.plan == 0:
+            self.history = PlanHistory(S.assignment, len(self.districts), self.keyframe_period)
+            nodes = np.arange(S.n)
+        else:
+            nodes = self.history.append(self.plan, S.assignment)
+        R = self.recs
+        R['plan'].append(len(nodes), plan=self.plan, geoid=nodes, district=S.assignment[nodes])
+        R['county'].append(len(S.counties), plan=self.plan, county=np.arange(len(S.counties)),
+            whole_defect=S.whole_defect, intersect_defect=S.intersect_defect, defect=S.defect)
+        R['district'].append(len(S.districts), plan=self.plan, district=np.arange(len(S.districts)),
+            total_pop=S.district_pop, pop_deviation=S.district_pop_deviation, polsby_popper=S.district_polsby_popper, aland=S.district_aland)
+        R['summary'].append(1, plan=self.plan, hash=self.hash, polsby_popper=self.polsby_popper, pop_deviation=self.pop_deviation,
+            intersect_defect=self.intersect_defect, whole_defect=self.whole_defect, defect=self.defect, **self.step_stats)
+        R['hash'].append(self.hash)
+        for a, x in self.step_stats.items():
+            self.totals[a] += x
+            self.step_stats[a] = 0
+
+
+    def tick(self, phase, t):
+        # charge the wall time since t to phase & return the current time for the next tick
+        now = time.perf_counter()
+        self.step_stats[f'time_{phase}'] += now - t
+        return now
+
+
+    def get_plan(self, plan=None):
+        # full plan (district of every node) at any recorded plan of this chain; defaults to the current plan
+        S = self.partition
+        assignment = S.assignment if plan is None else self.history.get(plan)
+        return pd.DataFrame({'random_seed':self.random_seed, 'plan':self.plan if plan is None else plan, 'geoid':S.geoids, 'district':S.districts[assignment]})
 
 
     def report(self):
         print(f'random_seed {self.random_seed}: step {self.plan} {time_formatter(time.time() - self.start_time)}, pop_deviation={self.pop_deviation:.1f}, intersect_defect={self.intersect_defect}, whole_defect={self.whole_defect}, defect={self.defect}', flush=True)
+        T = {a: self.totals[a] + self.step_stats[a] for a in self.totals}
+        total = sum(T[f'time_{p}'] for p in phases)
+        print(f'    time: ' + ', '.join(f'{p} {T[f"time_{p}"] / max(total, 1e-9):.0%}' for p in phases) + f' of {total:.1f}sec', flush=True)
+        print(f'    counts: ' + ', '.join(f'{c}={T[f"n_{c}"]}' for c in counters), flush=True)
 
 
     def recomb(self):
-        # Make backups - used to undo rejected steps
+        # No backups - every rejection test (pop_deviation, defect_cap, & yolo hash) is a dry run against self.partition,
+        # so a candidate is only applied once it has passed them all.
+        # districts below are district INDICES into self.partition.districts, not district labels
+        t = time.perf_counter()
         self.update()
-        self.graph_backup = self.graph.copy()
-        self.adj_backup   = self.adj.copy()
-
-        def accept():
-            for dist, comp in zip(districts, components):
-                cuts = tuple((dist, cty) for cty in self.adj[dist])
-                self.adj.remove_edges_from(cuts)  # cut all edges of self.adj touching d0 or d1
-                for n in comp:
-                    self.graph.nodes[n]['district'] = dist  # relabel nodes
-                    self.adj.add_edge(dist, self.graph.nodes[n]['county'])
-
-        def reject():
-            T.add_edge(*e)  # restore e
-            self.adj = self.adj_backup.copy()  # restore self.adj
-            for n in H.nodes:
-                self.graph.nodes[n]['district'] = self.graph_backup.nodes[n]['district']
-
-        # Make generator to yield district pairs in random order weighted by population difference
+        S = self.partition
+        C = self.step_stats
+
+        # Draw bordering district pairs in random order weighted by population difference
         # yields pairs with large pop difference first to encourage convergence to population balance.
         # To disable weighting (purely random sample), set pop_diff_exp=0
-        # Make dataframe of district pairs with pop_difference raised to pop_diff_exp
-        def gen(R):
-            while len(R) > 0:
-                p = R / R.sum()
-                r = self.rng.choice(R.index, p=p)  # yield from remaining pairs with prefence for larger population difference
-                R.pop(r)
-                yield r
+        # Set boundary_exp > 0 to also favor pairs sharing a long boundary.
+        # self.pairs samples without replacement & persists across steps - only pairs involving the 2 districts
+        # changed by the last step get new weights.  It is rebuilt only when pop_diff_exp changes.
         push_deviation = self.pop_deviation > self.pop_deviation_target
         pop_diff_exp = 2 * push_deviation
-        P = self.district_df[['district', 'total_pop']].values
-        Q = pd.DataFrame([(x, y, abs(p-q)) for x, p in P for y, q in P if x < y]).set_index([0,1]).squeeze()
-        R = (Q / Q.sum()) ** pop_diff_exp
-        pairs = gen(R)
+        # Phase 1: If pop_deviation too high, reject steps that increase it
+        # Phase 2: If pop_deviation within target range, reject steps that would leave target range
+        bound = self.pop_deviation if push_deviation else self.pop_deviation_target
+        if pop_diff_exp != self.pop_diff_exp:
+            self.pop_diff_exp = pop_diff_exp
+            self.pairs = FenwickSampler(self.pair_weights())
+            self.infeasible = set()
+        elif self.infeasible:
+            # Pairs found infeasible keep weight 0 until a step changes one of their districts (see below).
+            # A step elsewhere can also move p_min or p_max, so recheck them all at once & put back any that became feasible.
+            idx = np.array(sorted(self.infeasible))
+            idx = idx[self.pair_feasible(idx, bound)]
+            self.infeasible.difference_update(idx.tolist())
+            self.pairs.update(idx, self.pair_weights(idx))
         
         while True:
-            try:
-                districts = next(pairs)
-            except StopIteration:
+            r = self.pairs.draw(self.rng)
+            if r is None:
                 rpt(f'exhausted all district pairs - I think I am stuck')
+                self.pairs.restore()
+                self.tick('pairs', t)
                 return False
+            districts = tuple(self.pair_index[r].tolist())
+            C['n_pairs'] += 1
 
-            H = district_view(self.graph, districts)
-            if not nx.is_connected(H):  # if H not connected, go to next district pair
+            # Skip pairs whose populations cannot possibly be split within bound, without sampling any trees.
+            if not self.pair_feasible(r, bound)[0]:
+                self.infeasible.add(r)
+                self.pairs.update(r, 0)
+                C['n_pairs_infeasible'] += 1
                 continue
 
-            P = self.district_df.set_index('district')['total_pop']
-            q = P.pop(districts[0]) + P.pop(districts[1])
+            # Only bordering pairs have positive weight, so the merged region is connected whenever both districts are.
+            # A district can start disconnected (e.g. a seed plan with islands), & wilson_tree never finishes on a disconnected region,
+            # so check anyway & go to the next district pair.
+            region = S.region(districts)
+            if not S.is_connected(region):
+                continue
+
+            P = np.delete(S.district_pop, districts)
+            q = S.district_pop[list(districts)].sum()
             p_min, p_max = P.min(), P.max()
             # q is population of d0 & d1
             # P lists all OTHER district populations
             # So P_min & P_max are the min & max population of all districts except d0 & d1
 
             trees = []  # track which spanning trees we've tried so we don't repeat failures
-            Edges = get_edges(H)
+            indptr, indices, edges = S.subgraph(region)
+            pop = S.total_pop[region]
+            t = self.tick('pairs', t)
             for i in range(100):  # max number of spanning trees to try before going to next district pair
-                # We want a random spanning tree, but networkx can only deterministically find a MINIMUM spanning tree (Kruskal's algorithm).
-                # So, we first assign random weights to the edges then find MINIMUM spanning tree based on those random weights
-                # thus producing a random spanning tree.
-                for e in Edges:
-                    H.edges[e]['weight'] = self.rng.uniform()
-                T = nx.minimum_spanning_tree(H)
-                h = get_edges(T).__hash__()   # store T's hash so we avoid trying it again later if it fails
-                if h not in trees:  # prevents retrying a previously failed treee
+                # Draw a uniformly random spanning tree of the merged region using Wilson's algorithm (see wilson_tree in recom.py).
+                # This replaces assigning random edge weights & taking a minimum spanning tree, which is slower and NOT uniform.
+                parent = wilson_tree(indptr, indices, self.rng)
+                E = np.sort(tree_edges(parent), axis=1)
+                h = E[np.lexsort(E.T[::-1])].tobytes().__hash__()   # store T's hash so we avoid trying it again later if it fails
+                C['n_trees'] += 1
+                t = self.tick('trees', t)
+                if h in trees:
+                    C['n_trees_repeat'] += 1
+                else:  # prevents retrying a previously failed treee
                     trees.append(h)
-                    # Make search for good edge cut with population balance more efficient by looking at edges with high betweenness-centrality.
-                    # Since cutting an edge near the leaves of the tree is very unlikely to produce population balance,
-                    # we focus on edges near the center.  Betweenness-centrality is a good metric for this.
-                    B = nx.edge_betweenness_centrality(T)
-                    B = sorted(B.items(), key=lambda x:x[1], reverse=True)  # sort edges on betweenness-centrality (largest first)
-                    for e, bw_centrality in B:
-                        if bw_centrality < 0.1: # We exhausted all good edges - move on to next tree
-                            break
-                        T.remove_edge(*e)
-                        components = get_components(T, sort=False)  # T nows has 2 components
-                        next(components)  # second component tends to be smaller → faster to sum over
-                        s = sum(H.nodes[n]['total_pop'] for n in next(components))  # sum population in second component 
-                        t = q - s  # population in first component (recall q is the combined population of d0 & d1)
-                        if s > t:  # ensure s < t
-                            s, t = t, s
-                        pop_deviation_min = self.target_pop - min(s, p_min)
-                        pop_deviation_max = max(t, p_max) - self.target_pop
-                        pop_deviation_new = (pop_deviation_min + pop_deviation_max) / self.target_pop * 100  # new pop deviation
-                        
-                        # Phase 1: If pop_deviation too high, reject steps that increase it
-                        if push_deviation:
-                            if pop_deviation_new > self.pop_deviation:
-                                T.add_edge(*e)
-                                continue
-                        # Phase 2: If pop_deviation within target range, reject steps that would leave target range
-                        else:
-                            if pop_deviation_new > self.pop_deviation_target:
-                                T.add_edge(*e)
-                                continue
-
-                        components = get_components(T)
-                        accept()
-                         # if we've seen that plan recently, reject and try again
-                        h = get_hash(self.graph)
-                        if h in self.recs['hash'][-self.yolo_length:]:
-                            reject()
-                            continue
+                    # One post-order pass over the tree gives the population below every edge,
+                    # hence the new pop_deviation for cutting every edge & the set of all edges that satisfy the phase rule above.
+                    # Try those cut edges in uniformly random order.
+                    cuts, order, pos, size, dev = feasible_cuts(parent, pop, q, p_min, p_max, self.target_pop, bound)
+                    C['n_trees_no_cut'] += len(cuts) == 0
+                    t = self.tick('cuts', t)
+                    for c in self.rng.permutation(cuts):
+                        C['n_edges'] += 1
+                        pop_deviation_new = dev[c]
+                        sub = np.zeros(len(region), dtype=bool)
+                        sub[order[pos[c]:pos[c]+size[c]]] = True  # nodes below the cut edge
+                        components = sorted([region[sub], region[~sub]], key=len, reverse=True)
+                        nodes = np.concatenate(components)
+                        new = np.repeat(districts, [len(comp) for comp in components])
 
-#                         if defect exceeds cap, reject and try again
-                        old_defect = self.defect
-                        self.get_county_stats()
-                        if self.defect > self.defect_cap and self.defect > old_defect:
-                            reject()
-                            self.get_county_stats()
-                            self.defect = old_defect
+                        # if defect would exceed cap, try next cut edge.  Dry run - only counties touching d0 & d1 are re-evaluated.
+                        defect_new = S.defect_if(nodes, new)
+                        if defect_new > self.defect_cap and defect_new > S.total_defect:
+                            C['n_rej_defect'] += 1
+                            t = self.tick('checks', t)
                             continue
 
-                        self.update()
-                        assert abs(self.pop_deviation - pop_deviation_new) < 1e-2, f'disagreement betwen pop_deviation calculations {self.pop_deviation} v {pop_deviation_new}'
+                        # if we've seen that plan recently, try next cut edge.  Dry run - hash updates in O(moved nodes).
+                        h = S.hash_if(nodes, new)
+                        if h in self.recs['hash'][-self.yolo_length:]:
+                            C['n_rej_yolo'] += 1
+                            t = self.tick('checks', t)
+                            continue
+                        t = self.tick('checks', t)
 
-                        # We found a good cut edge & made 2 new districts.  They will be label with the values of d0 & d1.
+                        # We found a good cut edge & will make 2 new districts.  They will be label with the values of d0 & d1.
                         # But which one should get d0?  This is surprisingly important so colors "look right" in animations.
                         # Else, colors can get quite "jumpy" and give an impression of chaos and instability
-                        # To achieve this, add aland of nodes that have the same od & new district label
+                        # To achieve this, add aland of nodes that have the same old & new district label
                         # and subtract aland of nodes that change district label.  If negative, swap d0 & d1.
                         s = 0
                         for dist, comp in zip(districts, components):
-                            for n in comp:
-                                ds = self.graph.nodes[n]['aland']
-                                if self.graph.nodes[n]['district'] == dist:
-                                    s += ds
-                                else:
-                                    s -= ds
+                            same = S.assignment[comp] == dist
+                            s += S.aland[comp[same]].sum() - S.aland[comp[~same]].sum()
                         if s < 0:
-                            components[0], components[1] = components[1], components[0]
-                            accept()
-                            self.update()
+                            new = np.repeat(districts[::-1], [len(comp) for comp in components])
+
+                        S.assign(nodes, new)  # relabel both components in one move so neither district is ever momentarily empty
+                        self.pairs.restore()
+                        idx = np.union1d(self.district_pairs[districts[0]], self.district_pairs[districts[1]])
+                        self.pairs.update(idx, self.pair_weights(idx))
+                        self.infeasible.difference_update(idx.tolist())
+                        self.update()
+                        assert abs(self.pop_deviation - pop_deviation_new) < 1e-2, f'disagreement betwen pop_deviation calculations {self.pop_deviation} v {pop_deviation_new}'
+                        self.tick('accept', t)
                         return True
+                    t = self.tick('cuts', t)
+            C['n_pairs_exhausted'] += 1
 
         
+    def pair_weights(self, idx=slice(None)):
+        # sampling weight of district pairs idx: (population difference / total_pop) ** pop_diff_exp * shared boundary ** boundary_exp
+        # for pairs that border each other & 0 for all others.
+        # A step only changes the populations & borders of its 2 districts, so only their pairs need new weights afterwards.
+        S = self.partition
+        x, y = self.pair_index[idx].T
+        pop = S.district_pop
+        adj = S.adjacent(x, y)
+        w = (np.abs(pop[x] - pop[y]) / self.total_pop) ** self.pop_diff_exp * np.where(adj, S.district_boundary[x, y], 1) ** self.boundary_exp
+        return np.where(adj, w, 0)
+
+
+    def pair_feasible(self, idx, bound):
+        # whether district pairs idx pass the population precheck pair_feasible (see recom.py) for pop_deviation <= bound
+        S = self.partition
+        x, y = np.atleast_2d(self.pair_index[idx]).T
+        p_min, p_max = excluding_pairs(S.district_pop, x, y)
+        return pair_feasible(S.district_pop[x] + S.district_pop[y], p_min, p_max,
+                             np.minimum(S.district_node_min[x], S.district_node_min[y]),
+                             np.maximum(S.district_node_max[x], S.district_node_max[y]), self.target_pop, bound)
+
+
     def get_county_stats(self):
         # The "county-line" rule prefers minimal county & district splitting. We implement as follows:
         # seats_share = county population / distrinct ideal population
@@ -299,93 +539,45 @@ on
         # whole_defect = |actual wholly contained - floor(seats_share)|
         # intersect_defect = |actual intersected - ceil(seats_share)|
         # defect = whole_defect + intersect_defect
-        self.intersect_defect = 0
-        self.whole_defect = 0
-        self.defect = 0
-        for c in self.counties:
-            w = sum(self.adj.degree[d] == 1 for d in self.adj[c])
-            dw = abs(self.adj.nodes[c]['whole_target'] - w)
-            i = self.adj.degree[c]
-            di = abs(self.adj.nodes[c]['intersect_target'] - i)
-            self.whole_defect += dw
-            self.intersect_defect += di
-            self.defect += (dw + di)
-            
-            self.adj.nodes[c]['whole'] = w
-            self.adj.nodes[c]['intersect'] = i            
-            self.adj.nodes[c]['whole_defect'] = dw
-            self.adj.nodes[c]['intersect_defect'] = di
-            self.adj.nodes[c]['defect'] = (dw + di)
+        # self.partition maintains these incrementally, re-evaluating only counties touched by each move
+        S = self.partition
+        self.intersect_defect = S.total_intersect_defect
+        self.whole_defect     = S.total_whole_defect
+        self.defect           = S.total_defect
             
             
     def get_district_stats(self):
-        # compute district stats & store in self.adj
-        # initialize to 0
-        attrs = ['total_pop', 'aland', 'perim']
-        for d in self.districts:
-            for a in attrs:
-                self.adj.nodes[d][a] = 0
-            self.adj.nodes[d]['internal_perim'] = 0
-        
-        # iterate over nodes in self.graph and increment corresponding district node in self.adj
-        for n, data_node in self.graph.nodes(data=True):
-            d = data_node['district']
-            for a in attrs:
-                self.adj.nodes[d][a] += data_node[a]
-
-        # iterate over edges in self.graph and increment corresponding district node in self.adj
-        for u, v, data_edge in self.graph.edges(data=True):
-            d = self.graph.nodes[u]['district']
-            if self.graph.nodes[v]['district'] == d: # if u & v in same district, (u, v) is an internal edge
-                self.adj.nodes[d]['internal_perim'] += 2 * data_edge['shared_perim']  # must double because this boundary piece counts in perim for BOTH u & v
-
-        dev_min =  10000
-        dev_max = -10000
-        self.polsby_popper = 0
-        for d in self.districts:
-            stats = self.adj.nodes[d]
-            # computer external_perim & polsby-popper (aland, perim, & internal perim computed in prior loops)
-            stats['external_perim'] = stats['perim'] - stats['internal_perim']
-            stats['polsby_popper'] = 4 * np.pi * stats['aland'] / (stats['external_perim']**2) * 100
-            self.polsby_popper += stats['polsby_popper']
-            
-            # compute pop_deivations and update dev_min & dev_max
-            stats['pop_deviation'] = (stats['total_pop'] - self.target_pop) / self.target_pop * 100
-            dev_min = min(dev_min, stats['pop_deviation'])
-            dev_max = max(dev_max, stats['pop_deviation'])
-        self.pop_deviation = abs(dev_max) + abs(dev_min)
-        self.polsby_popper /= len(self.districts)
+        # per-district total_pop, aland, perim, internal_perim, polsby_popper, & pop_deviation
+        # are maintained incrementally by self.partition as nodes change district
+        S = self.partition
+        self.pop_deviation = abs(S.district_pop_deviation.max()) + abs(S.district_pop_deviation.min())
+        self.polsby_popper = S.district_polsby_popper.mean()
         
         
+    def export(self):
+        # Write the current plan from self.partition back onto self.graph & rebuild self.adj, for notebooks & inspection.
+        # Never called by the chain: a CompactGraph becomes a full networkx graph here, giving up the shared memory map.
+        if isinstance(self.graph, CompactGraph):  # the file is read-only - switch to networkx
+            self.graph = self.graph.to_networkx()
+        self.partition.to_graph(self.graph)
+        self.get_adj()
+
+
     def get_adj(self):
-        src = 'adj'
-        rpt
         # Create the county-district bi-partite adjacency graph.
         # This graph has 1 node for each county and district &
         # an edge for all (county, district) that intersect (share land).
-        # It is an efficient tool to track map defect and other properties.
+        # The chain tracks this in self.partition.county_district; self.adj is only built for export & inspection.
+        S = self.partition
+        self.get_county_stats()
+        self.get_district_stats()
         self.adj = nx.Graph()
-        for n, data in self.graph.nodes(data=True):
-            D = data['district']
-            self.adj.add_node(D)  # adds district node if not already present
-            self.adj.nodes[D]['polsby_popper'] = 0
-            for k in ['total_pop', 'aland', 'perim']:
-                try:
-                    self.adj.nodes[D][k] += data[k]  # add to attribute if exists
-                except:
-                    self.adj.nodes[D][k] = data[k]  # else create attribute
-
-            C = data['county']
-            self.adj.add_node(C)  # adds county node if not already present
-            for k in ['total_pop', 'seats']:
-                try:
-                    self.adj.nodes[C][k] += data[k]  # add to attribute if exists
-                except:
-                    self.adj.nodes[C][k] = data[k]  # else create attribute
-
-            self.adj.add_edge(C, D)  # create edge
-
-        # get defect targets
-        for C in self.counties:
-            self.adj.nodes[C]['whole_target']     = int(np.floor(self.adj.nodes[C]['seats']))
-            self.adj.nodes[C]['intersect_target'] = int(np.ceil (self.adj.nodes[C]['seats']))
+        for d, D in enumerate(S.districts.tolist()):
+            self.adj.add_node(D, total_pop=S.district_pop[d], aland=S.district_aland[d], perim=S.district_perim[d],
+                              internal_perim=S.district_internal_perim[d], polsby_popper=S.district_polsby_popper[d], pop_deviation=S.district_pop_deviation[d])
+        county_pop = np.bincount(S.county, weights=S.total_pop, minlength=len(S.counties))
+        for c, C in enumerate(S.counties.tolist()):
+            self.adj.add_node(C, total_pop=county_pop[c], seats=S.seats[c], whole_target=S.whole_target[c], intersect_target=S.intersect_target[c],
+                              whole=S.whole[c], intersect=S.intersect[c], whole_defect=S.whole_defect[c], intersect_defect=S.intersect_defect[c], defect=S.defect[c])
+        for c, d in zip(*np.nonzero(S.county_district)):
+            self.adj.add_edge(S.counties[c], S.districts[d])
@@ -0,0 +1,90 @@
+from .mcmc import *
+import multiprocessing, multiprocessing.connection
+from multiprocessing import shared_memory
+
+class SharedArrays():
+    # numpy arrays copied ONCE into multiprocessing.shared_memory so every chain worker maps the same pages.
+    # Workers attach read-only views by name (spec), so nothing is pickled or copied per worker.
+    def __init__(self, arrays):
+        self.blocks = dict()
+        self.spec = dict()
+        for name, x in arrays.items():
+            x = np.ascontiguousarray(x)
+            assert x.dtype != object, f'{name} has dtype object, which cannot live in shared memory'
+            shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+            np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+            self.blocks[name] = shm
+            self.spec[name] = (shm.name, x.shape, x.dtype.str)
+
+
+    @staticmethod
+    def attach(spec):
+        # read-only arrays backed by the shared blocks in spec; returns (arrays, blocks) - keep blocks alive while using arrays
+        arrays, blocks = dict(), list()
+        for name, (shm_name, shape, dtype) in spec.items():
+            shm = shared_memory.SharedMemory(name=shm_name)
+            x = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            x.flags.writeable = False
+            arrays[name] = x
+            blocks.append(shm)
+        return arrays, blocks
+
+
+    def close(self):
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.blocks = dict()
+
+
+def chain_worker(M, spec, random_seeds, progress):
+    # Runs in a forked child: attach the shared graph arrays & run each seed as its own chain.
+    # Each chain owns only its assignment array, rng, & records.
+    arrays, blocks = SharedArrays.attach(spec)
+    assignment = M.partition.assignment
+    M.partition = None  # drop the parent's copy so only the shared arrays are referenced
+    for random_seed in random_seeds:
+        try:
+            C = M.spawn(random_seed, PartitionState(**arrays, assignment=assignment.copy()))
+            C.progress = progress
+            C.run_chain()
+        except Exception as e:
+            print(f'random_seed {random_seed} failed: {e!r}', flush=True)
+
+
+@dataclasses.dataclass
+class MultiChain():
+    # Run many MCMC chains on one machine from a single MCMC built once in this process.
+    # The graph & node attributes (everything in PartitionState except assignment) are placed in shared memory once
+    # & forked workers attach to them, so startup & resident memory scale with the graph once, not once per worker.
+    M              : MCMC
+    random_seeds   : typing.Any
+    workers        : int = multiprocessing.cpu_count()
+    report_period  : float = 60  # seconds between aggregate progress reports
+
+    def run(self):
+        ctx = multiprocessing.get_context('fork')
+        random_seeds = np.atleast_1d(self.random_seeds).tolist()
+        workers = max(1, min(self.workers, len(random_seeds)))
+        progress = ctx.Value('q', 0)
+        shared = SharedArrays(self.M.partition.static())
+        try:
+            procs = [ctx.Process(target=chain_worker, args=(self.M, shared.spec, random_seeds[w::workers], progress)) for w in range(workers)]
+            self.start_time = time.time()
+            for p in procs:
+                p.start()
+            alive = procs
+            while alive:
+                ready = multiprocessing.connection.wait([p.sentinel for p in alive], timeout=self.report_period)
+                for p in alive:
+                    if p.sentinel in ready:
+                        p.join()
+                alive = [p for p in alive if p.exitcode is None]
+                self.report(progress.value, workers)
+        finally:
+            shared.close()
+
+
+    def report(self, steps, workers):
+        elapsed = time.time() - self.start_time
+        print(f'{workers} workers: {steps} steps in {time_formatter(elapsed)}, {steps / max(elapsed, 1e-9):.2f} steps/sec', flush=True)
@@ -0,0 +1,359 @@
+from .graphfile import *
+
+@dataclasses.dataclass
+class PartitionState():
+    # Compact array-backed districting plan used by the MCMC hot path.
+    # Nodes, counties, and districts are referred to by integer index (position in geoids, counties, and districts).
+    # The graph itself never changes during a chain, so it is stored once in CSR form:
+    # the neighbors of node i are indices[indptr[i]:indptr[i+1]] and shared_perim is aligned with indices.
+    # Only assignment (node -> district index) and the per-district/per-county caches derived from it change.
+    geoids       : np.ndarray
+    indptr       : np.ndarray
+    indices      : np.ndarray
+    shared_perim : np.ndarray
+    total_pop    : np.ndarray
+    aland        : np.ndarray
+    perim        : np.ndarray
+    county       : np.ndarray
+    counties     : np.ndarray
+    seats        : np.ndarray
+    districts    : np.ndarray
+    assignment   : np.ndarray
+    keys         : np.ndarray = None  # node_keys(geoids), computed if not given
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, val):
+        return setattr(self, key, val)
+
+    def __post_init__(self):
+        self.n = len(self.geoids)
+        self.index = {g: i for i, g in enumerate(self.geoids)}
+        if self.keys is None:
+            self.keys = node_keys(self.geoids)
+        self.target_pop = self.total_pop.sum() / len(self.districts)
+        self.whole_target     = np.floor(self.seats).astype(int)
+        self.intersect_target = np.ceil (self.seats).astype(int)
+        self.local = np.full(self.n, -1, dtype=np.int64)  # scratch global -> local index map reused by subgraph
+        self.version = 0  # bumped whenever assignment changes, so callers can tell when derived statistics are stale
+        self.reset()
+
+
+    @classmethod
+    def from_graph(cls, G):
+        # Build from the graph produced by Space.get_graph - networkx or CompactGraph (see graphfile.py)
+        if isinstance(G, CompactGraph):
+            return cls.from_compact(G)
+        geoids = np.array(sorted(G.nodes))
+        index = {g: i for i, g in enumerate(geoids)}
+        node = lambda a: np.array([G.nodes[g][a] for g in geoids])
+
+        E = np.array([(index[u], index[v], w) for u, v, w in G.edges(data='shared_perim')], dtype=float).reshape(-1, 3)
+        src = np.concatenate([E[:,0], E[:,1]]).astype(np.int64)  # store both directions
+        dst = np.concatenate([E[:,1], E[:,0]]).astype(np.int64)
+        wgt = np.concatenate([E[:,2], E[:,2]])
+        order = np.lexsort((dst, src))
+        indptr = np.zeros(len(geoids)+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(src, minlength=len(geoids)))
+
+        counties, county = np.unique(node('county'), return_inverse=True)
+        districts, assignment = np.unique(node('district'), return_inverse=True)
+        return cls(geoids=geoids, indptr=indptr, indices=dst[order], shared_perim=wgt[order],
+                   total_pop=node('total_pop'), aland=node('aland').astype(float), perim=node('perim').astype(float),
+                   county=county.astype(np.int64), counties=counties, seats=np.bincount(county, weights=node('seats'), minlength=len(counties)),
+                   districts=districts, assignment=assignment.astype(np.int64))
+
+
+    @classmethod
+    def from_compact(cls, G):
+        # Same arrays as from_graph without materializing networkx objects.
+        # The CSR arrays & numeric node columns stay memory-mapped; only geoids, county, & district are decoded.
+        geoids = decode_column(G.geoids)
+        counties, county = np.unique(decode_column(G.node['county']), return_inverse=True)
+        districts, assignment = np.unique(decode_column(G.node['district']), return_inverse=True)
+        return cls(geoids=geoids, indptr=G.indptr, indices=G.indices, shared_perim=G.edge['shared_perim'].astype(float, copy=False),
+                   total_pop=G.node['total_pop'], aland=G.node['aland'].astype(float, copy=False), perim=G.node['perim'].astype(float, copy=False),
+                   county=county.astype(np.int64), counties=counties, seats=np.bincount(county, weights=G.node['seats'], minlength=len(counties)),
+                   districts=districts, assignment=assignment.astype(np.int64))
+
+
+    def static(self):
+        # every field that never changes during a chain, i.e. all but assignment - see multichain.py
+        return {f.name: self[f.name] for f in dataclasses.fields(self) if f.name != 'assignment'}
+
+
+    def reset(self):
+        # (re)compute every cache from assignment from scratch
+        self.version += 1
+        k = len(self.districts)
+        self.members = [np.flatnonzero(self.assignment == d) for d in range(k)]
+        self.district_pop = np.bincount(self.assignment, weights=self.total_pop, minlength=k).astype(self.total_pop.dtype)
+        # county_district[c, d] = number of nodes of county c in district d.  Replaces the county/district bipartite graph.
+        self.county_district = np.zeros((len(self.counties), k), dtype=np.int64)
+        np.add.at(self.county_district, (self.county, self.assignment), 1)
+        self.get_district_stats()
+        self.get_district_dual()
+        self.get_county_stats()
+        # district_key[d] = sum of node keys in district d (mod 2**64) - see get_hash in __init__.py
+        self.district_key = np.zeros(k, dtype=np.uint64)
+        np.add.at(self.district_key, self.assignment, self.keys)
+        self.plan_key = plan_key(self.district_key)
+
+
+    def state(self):
+        # assignment & the caches accumulated in floating point, whose last bits depend on the order of moves.
+        # load_state restores them exactly rather than recomputing them with reset.
+        return {a: self[a].copy() for a in ['assignment', 'district_aland', 'district_perim', 'district_internal_perim', 'district_boundary']}
+
+
+    def load_state(self, state):
+        self.assignment[:] = state['assignment']
+        self.reset()
+        for a, x in state.items():
+            self[a][:] = x
+        self.refresh_districts(np.arange(len(self.districts)))
+
+
+    def moved(self, nodes, new):
+        # restrict a proposed move to the nodes that actually change district; returns (nodes, old, new)
+        nodes = np.asarray(nodes, dtype=np.int64)
+        new   = np.broadcast_to(np.asarray(new, dtype=np.int64), nodes.shape)
+        old   = self.assignment[nodes]
+        moved = old != new
+        return nodes[moved], old[moved], new[moved]
+
+
+    def assign(self, nodes, new):
+        # move nodes to districts new (array of district indices aligned with nodes)
+        nodes, old, new = self.moved(nodes, new)
+        if len(nodes) == 0:
+            return
+        self.version += 1
+        k = len(self.districts)
+        delta = lambda w: np.bincount(new, weights=w, minlength=k) - np.bincount(old, weights=w, minlength=k)
+        self.district_pop   += delta(self.total_pop[nodes]).astype(self.district_pop.dtype)
+        self.district_aland += delta(self.aland[nodes])
+        self.district_perim += delta(self.perim[nodes])
+        touched, cols, degree, counties, whole, intersect = self.county_change(nodes, old, new)
+        self.county_district[:, touched] = cols
+        self.district_degree[touched] = degree
+        self.set_county_stats(counties, whole, intersect)
+        touched, keys, self.plan_key = self.key_change(nodes, old, new)
+        self.district_key[touched] = keys
+        # internal_perim & the district dual only change along edges touching moved nodes
+        src, edges = self.edges_from(nodes)
+        dst = self.indices[edges]
+        self.local[nodes] = 1
+        inner = self.local[dst] == 1  # both endpoints move
+        self.local[nodes] = -1
+        # an edge between a moved & an unmoved node is seen only once here, but counts twice in internal_perim
+        w = self.shared_perim[edges] * np.where(inner, 1, 2)
+        internal = lambda: np.bincount(self.assignment[src], weights=w * (self.assignment[src] == self.assignment[dst]), minlength=k)
+        self.district_internal_perim -= internal()
+        self.dual_change(src, dst, edges, inner, -1)
+        self.assignment[nodes] = new
+        self.district_internal_perim += internal()
+        self.dual_change(src, dst, edges, inner, 1)
+        for d in touched:
+            region = np.union1d(self.members[d], nodes)
+            self.members[d] = region[self.assignment[region] == d]
+        self.refresh_districts(touched)
+
+
+    def region(self, districts):
+        # sorted node indices of the given district indices
+        return np.sort(np.concatenate([self.members[d] for d in districts]))
+
+
+    def subgraph(self, nodes):
+        # CSR of the subgraph induced by sorted node indices nodes.
+        # Returns (indptr, indices, edges) in local numbering; edges are positions into self.indices for edge attributes.
+        nodes = np.asarray(nodes, dtype=np.int64)
+        m = len(nodes)
+        src, edges = self.edges_from(np.arange(m), nodes)
+        self.local[nodes] = np.arange(m)
+        nbr = self.local[self.indices[edges]]
+        self.local[nodes] = -1
+        keep = nbr >= 0
+        indptr = np.zeros(m+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(src[keep], minlength=m))
+        return indptr, nbr[keep], edges[keep]
+
+
+    def edges_from(self, labels, nodes=None):
+        # all CSR edge positions leaving nodes, together with the label of the node each edge leaves
+        # (labels defaults to the node indices themselves)
+        if nodes is None:
+            nodes = labels
+        deg = self.indptr[nodes+1] - self.indptr[nodes]
+        offset = np.concatenate([[0], np.cumsum(deg)[:-1]])
+        edges = np.repeat(self.indptr[nodes] - offset, deg) + np.arange(deg.sum())
+        return np.repeat(labels, deg), edges
+
+
+    def is_connected(self, nodes):
+        indptr, indices, edges = self.subgraph(nodes)
+        m = len(indptr) - 1
+        if m == 0:
+            return True
+        seen = np.zeros(m, dtype=bool)
+        seen[0] = True
+        stack = [0]
+        count = 1
+        while stack:
+            i = stack.pop()
+            for j in indices[indptr[i]:indptr[i+1]]:
+                if not seen[j]:
+                    seen[j] = True
+                    count += 1
+                    stack.append(j)
+        return count == m
+
+
+    def get_district_stats(self):
+        # per-district total_pop, aland, perim, and internal_perim from scratch.
+        # Only needed at reset; assign keeps them up to date incrementally.
+        k = len(self.districts)
+        self.district_aland = np.bincount(self.assignment, weights=self.aland, minlength=k)
+        self.district_perim = np.bincount(self.assignment, weights=self.perim, minlength=k)
+        src = np.repeat(self.assignment, np.diff(self.indptr))
+        internal = src == self.assignment[self.indices]
+        # each edge appears twice in CSR, which supplies the factor 2 (shared boundary counts in perim for BOTH endpoints)
+        self.district_internal_perim = np.bincount(src[internal], weights=self.shared_perim[internal], minlength=k)
+        self.district_polsby_popper = np.zeros(k)
+        self.district_pop_deviation = np.zeros(k)
+        self.district_node_min = np.zeros(k)  # smallest & largest node population in each district
+        self.district_node_max = np.zeros(k)
+        self.refresh_districts(np.arange(k))
+
+
+    def get_district_dual(self):
+        # District dual graph from scratch: district_edges[d, e] = # graph edges between districts d & e
+        # and district_boundary[d, e] = their shared boundary (sum of shared_perim).
+        # Districts d != e border each other iff district_edges[d, e] > 0.
+        # Only needed at reset; assign keeps them up to date incrementally.
+        k = len(self.districts)
+        src = np.repeat(self.assignment, np.diff(self.indptr))
+        dst = self.assignment[self.indices]
+        # each edge appears twice in CSR, once for each direction, so both [d, e] & [e, d] are counted
+        self.district_edges = np.zeros((k, k), dtype=np.int64)
+        np.add.at(self.district_edges, (src, dst), 1)
+        self.district_boundary = np.zeros((k, k))
+        np.add.at(self.district_boundary, (src, dst), self.shared_perim)
+
+
+    def dual_change(self, src, dst, edges, inner, sign):
+        # add (sign=1) or remove (sign=-1) the CSR edges leaving moved nodes from the district dual.
+        # Edges between 2 moved nodes appear in both directions already; the reverse of an edge to an unmoved node must be added here.
+        a = self.assignment[src]
+        b = self.assignment[dst]
+        w = self.shared_perim[edges]
+        for X, x in [(self.district_edges, np.ones(len(edges), dtype=np.int64)), (self.district_boundary, w)]:
+            np.add.at(X, (a, b), sign * x)
+            np.add.at(X, (b[~inner], a[~inner]), sign * x[~inner])
+
+
+    def adjacent(self, x, y):
+        # True where districts x & y border each other (works elementwise on arrays)
+        return (self.district_edges[x, y] > 0) & (np.asarray(x) != np.asarray(y))
+
+
+    def refresh_districts(self, districts):
+        # refresh polsby_popper, pop_deviation, & node population range of the given districts from their cached totals & members
+        external_perim = self.district_perim[districts] - self.district_internal_perim[districts]
+        self.district_polsby_popper[districts] = 4 * np.pi * self.district_aland[districts] / external_perim**2 * 100
+        self.district_pop_deviation[districts] = (self.district_pop[districts] - self.target_pop) / self.target_pop * 100
+        for d in np.atleast_1d(districts).tolist():
+            pop = self.total_pop[self.members[d]].astype(float)
+            self.district_node_min[d] = pop.min(initial=np.inf)
+            self.district_node_max[d] = pop.max(initial=0)
+
+
+    def get_county_stats(self):
+        # per-county whole, intersect, and defects from scratch - see MCMC.get_county_stats.
+        # Only needed at reset; assign keeps them up to date for the counties a move touches.
+        D = self.county_district > 0
+        self.district_degree = D.sum(axis=0)  # number of counties each district intersects
+        m = len(self.counties)
+        for a in ['whole', 'intersect', 'whole_defect', 'intersect_defect', 'defect']:
+            self[a] = np.zeros(m, dtype=np.int64)
+            self[f'total_{a}'] = 0
+        self.set_county_stats(np.arange(m), *self.count_districts(D, self.district_degree))
+
+
+    def count_districts(self, D, degree):
+        # D[c, d] = True iff county c intersects district d & degree[d] = number of counties district d intersects.
+        # Returns # districts wholly inside each county (district intersects only that county) & # districts intersecting it.
+        return (D & (degree == 1)).sum(axis=1), D.sum(axis=1)
+
+
+    def set_county_stats(self, counties, whole, intersect):
+        # store whole & intersect for counties, updating their defects & the totals over all counties
+        stats = {'whole': whole, 'intersect': intersect,
+                 'whole_defect'    : np.abs(self.whole_target    [counties] - whole),
+                 'intersect_defect': np.abs(self.intersect_target[counties] - intersect)}
+        stats['defect'] = stats['whole_defect'] + stats['intersect_defect']
+        for a, x in stats.items():
+            self[f'total_{a}'] += int(x.sum() - self[a][counties].sum())
+            self[a][counties] = x
+
+
+    def county_change(self, nodes, old, new):
+        # County bookkeeping for moving nodes from districts old to new WITHOUT modifying state.
+        # Only districts in the move (touched) change their county_district columns, so only counties they intersect
+        # before or after the move can change whole or intersect.
+        # Returns touched, their new county_district columns & degrees, and the affected counties with their new whole & intersect.
+        touched = np.union1d(old, new)
+        before = self.county_district[:, touched]
+        cols = before.copy()
+        np.add.at(cols, (self.county[nodes], np.searchsorted(touched, old)), -1)
+        np.add.at(cols, (self.county[nodes], np.searchsorted(touched, new)),  1)
+        counties = np.flatnonzero((before > 0).any(axis=1) | (cols > 0).any(axis=1))
+        degree = self.district_degree.copy()
+        degree[touched] = (cols > 0).sum(axis=0)
+        D = self.county_district[counties] > 0
+        D[:, touched] = cols[counties] > 0
+        return (touched, cols, degree[touched], counties, *self.count_districts(D, degree))
+
+
+    def key_change(self, nodes, old, new):
+        # keys of touched districts & the plan key after moving nodes from old to new WITHOUT modifying state.
+        # Only touched districts' terms of the plan key change, so this is O(moved nodes).
+        touched = np.union1d(old, new)
+        keys = self.district_key[touched].copy()
+        np.add.at(keys, np.searchsorted(touched, new), self.keys[nodes])
+        np.subtract.at(keys, np.searchsorted(touched, old), self.keys[nodes])
+        return touched, keys, self.plan_key - plan_key(self.district_key[touched]) + plan_key(keys)
+
+
+    def hash_if(self, nodes, new):
+        # dry run: plan hash if nodes were moved to districts new
+        nodes, old, new = self.moved(nodes, new)
+        return partition_hash(self.key_change(nodes, old, new)[2])
+
+
+    def defect_if(self, nodes, new):
+        # dry run: total defect if nodes were moved to districts new
+        nodes, old, new = self.moved(nodes, new)
+        if len(nodes) == 0:
+            return self.total_defect
+        touched, cols, degree, counties, whole, intersect = self.county_change(nodes, old, new)
+        defect = np.abs(self.whole_target[counties] - whole) + np.abs(self.intersect_target[counties] - intersect)
+        return self.total_defect + int(defect.sum() - self.defect[counties].sum())
+
+
+    def get_hash(self):
+        # same partition hash as get_hash(G) on the equivalent networkx graph, in O(districts)
+        return partition_hash(self.plan_key)
+
+
+    def labels(self):
+        # district label of each node
+        return self.districts[self.assignment]
+
+
+    def to_graph(self, G):
+        # write current assignment back onto networkx graph G (for export only)
+        nx.set_node_attributes(G, dict(zip(self.geoids.tolist(), self.labels().tolist())), 'district')
+        return G
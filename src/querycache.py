@@ -0,0 +1,113 @@
+from .backends import *
+import hashlib, json
+import pandas as pd
+
+################# Query result cache #################
+# Opt-in cache for run_query (see enable_query_cache in __init__.py).
+# A result is stored as root/<key>.parquet where key hashes the normalized SQL together with the last-modified time of
+# every table the query references, so editing the query or rewriting any input table is a miss.
+# Modified times are read from the table manifest (manifest.py), so a lookup makes no metadata calls; tables the manifest has no
+# entry for are asked of the backend.  As with the manifest, a table rewritten outside load_table & delete_table (e.g. DDL through
+# run_query) is only seen after a refresh, so clear the cache or refresh its dataset after such changes.
+# Hits touch their file; once the files exceed max_bytes the least recently used are deleted.
+# Only plain select queries are cached - not DDL, loads, or queries with rand() or current_* that differ per run.
+volatile_sql = re.compile(r'\b(rand|generate_uuid|current_\w+)\b', re.IGNORECASE)
+
+def normalize_sql(query):
+    # collapse whitespace & drop -- comments outside quoted strings, so formatting changes still hit
+    parts = bq_tokens.split(query)
+    for k in range(0, len(parts), 2):
+        parts[k] = ' '.join(re.sub(r'--[^\n]*', ' ', parts[k]).split())
+    return ''.join(parts).strip()
+
+
+def referenced_tables(query):
+    # project.dataset.table names in query, quoted in backticks or not
+    parts = bq_tokens.split(query)
+    names = {m.group(1) for p in parts[0::2] for m in bq_table_name.finditer(p)}
+    names.update(p[1:-1] for p in parts[1::2] if p[0] == '`' and p.count('.') == 2)
+    return sorted(names)
+
+
+def cacheable(query):
+    q = normalize_sql(query).lower()
+    return q.startswith(('select', 'with', '(')) and not volatile_sql.search(q)
+
+
+class QueryCache():
+    def __init__(self, root, max_bytes=10 * 2**30):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, query, modified):
+        # modified: last-modified time (or None if missing) of each referenced table
+        text = json.dumps([normalize_sql(query), sorted(modified.items())], default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+
+    def get(self, key):
+        path = self.root / f'{key}.parquet'
+        try:
+            df = pd.read_parquet(path)
+            os.utime(path)  # most recently used
+            return df
+        except (FileNotFoundError, OSError):
+            return None
+
+
+    def put(self, key, df):
+        path = self.root / f'{key}.parquet'
+        tmp = self.root / f'{key}.{os.getpid()}.tmp'  # several processes may store the same result at once
+        try:
+            df.to_parquet(tmp, index=False)
+        except Exception:  # e.g. a column type Parquet cannot hold - just don't cache it
+            tmp.unlink(missing_ok=True)
+            return
+        os.replace(tmp, path)
+        self.evict()
+
+
+    def evict(self):
+        files = list()
+        for p in self.root.glob('*.parquet'):
+            try:
+                s = p.stat()
+                files.append((s.st_mtime, s.st_size, p))
+            except FileNotFoundError:  # evicted by another process
+                pass
+        total = sum(f[1] for f in files)
+        for mtime, size, p in sorted(files):
+            if total <= self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+
+
+    def run(self, backend, query, manifest):
+        # run_query through the cache; modified times come from the manifest, asking backend only for tables it has no entry for
+        if not cacheable(query):
+            return backend.query(query)
+        modified = dict()
+        for t in referenced_tables(query):
+            modified[t] = manifest.modified(t)
+            if modified[t] is None:
+                modified[t] = backend.modified(t)
+        key = self.key(query, modified)
+        df = self.get(key)
+        if df is not None:
+            self.hits += 1
+            return df
+        self.misses += 1
+        df = backend.query(query)
+        if isinstance(df, pd.DataFrame):
+            self.put(key, df)
+        return df
+
+
+    def clear(self):
+        for p in self.root.glob('*.parquet'):
+            p.unlink(missing_ok=True)
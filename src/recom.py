@@ -0,0 +1,208 @@
+from . import *
+
+################# ReCom kernels on CSR index arrays #################
+# These work on the local (indptr, indices) of a merged district pair produced by PartitionState.subgraph.
+
+def wilson_tree(indptr, indices, rng, root=None, batch=4096):
+    # Uniform random spanning tree via Wilson's algorithm (loop-erased random walks).
+    # Returns parent array: parent[i] is the neighbor of i toward root & parent[root] = -1.
+    # Unlike assigning random weights and taking a minimum spanning tree, every spanning tree is equally likely.
+    # Graph must be connected.
+    m = len(indptr) - 1
+    # plain lists index much faster than numpy arrays inside a Python loop
+    ptr = indptr.tolist()
+    nbr = indices.tolist()
+    in_tree = [False] * m
+    parent  = [-1] * m
+    if root is None:
+        root = int(rng.integers(m))
+    in_tree[root] = True
+    # Calling rng once per walk step is the bottleneck, so draw uniforms in batches.
+    # Draws are consumed in a fixed order, so trees are reproducible given rng's state.
+    U = rng.random(batch).tolist()
+    k = 0
+    for start in rng.permutation(m).tolist():
+        # random walk from start until we hit the tree, remembering only the LAST exit from each node.
+        # Overwriting parent erases loops implicitly.
+        i = start
+        while not in_tree[i]:
+            if k == batch:
+                U = rng.random(batch).tolist()
+                k = 0
+            a = ptr[i]
+            parent[i] = nbr[a + int(U[k] * (ptr[i+1] - a))]
+            i = parent[i]
+            k += 1
+        # retrace the loop-erased path and add it to the tree
+        i = start
+        while not in_tree[i]:
+            in_tree[i] = True
+            i = parent[i]
+    return np.array(parent, dtype=np.int64)
+
+
+def tree_edges(parent):
+    # (child, parent) pairs of a tree given as a parent array
+    child = np.flatnonzero(parent >= 0)
+    return np.column_stack([child, parent[child]])
+
+
+def preorder(parent):
+    # DFS preorder of a tree given as a parent array.
+    # Every node comes after its parent & every subtree is a contiguous block, so
+    # the subtree of c is order[pos[c]:pos[c]+size[c]] where pos[order] = arange(m).
+    m = len(parent)
+    child = np.flatnonzero(parent >= 0)
+    kids = child[np.argsort(parent[child], kind='stable')].tolist()
+    ptr = [0] + np.cumsum(np.bincount(parent[child], minlength=m)).tolist()
+    stack = np.flatnonzero(parent < 0).tolist()
+    order = []
+    while stack:
+        i = stack.pop()
+        order.append(i)
+        stack.extend(kids[ptr[i]:ptr[i+1]])
+    return np.array(order, dtype=np.int64)
+
+
+def subtree_sums(parent, order, w):
+    # sum of w over the subtree rooted at each node in one pass over reverse preorder (children before parents)
+    par = parent.tolist()
+    tot = w.tolist()
+    for c in order[:0:-1].tolist():
+        tot[par[c]] += tot[c]
+    return np.array(tot)
+
+
+def split_pop_deviation(s, q, p_min, p_max, target_pop):
+    # pop_deviation after splitting a region of population q into s & q-s,
+    # where p_min & p_max are the min & max population of all OTHER districts.
+    # Works elementwise on arrays of s.
+    lo = np.minimum(s, q - s)
+    hi = np.maximum(s, q - s)
+    return ((target_pop - np.minimum(lo, p_min)) + (np.maximum(hi, p_max) - target_pop)) / target_pop * 100
+
+
+def excluding_pairs(w, x, y):
+    # min & max of w over all indices except x & y, elementwise over arrays of pairs x, y (needs len(w) >= 3).
+    # Only the 3 smallest & 3 largest entries of w can be the answer, so this is O(pairs) after one sort.
+    o = np.argsort(w, kind='stable')
+    x = np.atleast_1d(x)[:, None]
+    y = np.atleast_1d(y)[:, None]
+    def first(cand):
+        ok = (cand != x) & (cand != y)
+        return w[cand[ok.argmax(axis=1)]]
+    return first(o[:3]), first(o[::-1][:3])
+
+
+def pair_feasible(q, p_min, p_max, node_min, node_max, target_pop, bound):
+    # Cheap necessary condition for SOME split of a merged region to have pop_deviation <= bound (elementwise on arrays).
+    # q is the region's population, node_min & node_max its smallest & largest node population, and p_min & p_max as in split_pop_deviation.
+    # split_pop_deviation only decreases as the smaller side lo grows toward q/2.
+    # Each side holds at least 1 node, so node_min <= lo <= q - node_max, and the best possible split is lo = min(q/2, q - node_max).
+    # False means no spanning tree of the region can have a feasible cut edge.
+    lo = np.minimum(q / 2, q - node_max)
+    return (lo >= node_min) & (split_pop_deviation(lo, q, p_min, p_max, target_pop) <= bound)
+
+
+def feasible_cuts(parent, pop, q, p_min, p_max, target_pop, bound):
+    # Every cut edge (c, parent[c]) of the tree whose split has pop_deviation <= bound, found in one post-order pass.
+    # Returns (cuts, order, pos, size, dev): cuts are the child nodes c, the rest locate each subtree in order (see preorder).
+    order = preorder(parent)
+    pos = np.empty_like(order)
+    pos[order] = np.arange(len(order))
+    size = subtree_sums(parent, order, np.ones(len(order), dtype=np.int64))
+    dev = split_pop_deviation(subtree_sums(parent, order, pop), q, p_min, p_max, target_pop)
+    cuts = np.flatnonzero((parent >= 0) & (dev <= bound))
+    return cuts, order, pos, size, dev
+
+
+class FenwickSampler():
+    # Weighted sampling WITHOUT replacement over items 0..n-1 using a Fenwick (binary indexed) tree.
+    # draw, update, and restore cost O(log n) per item, so a few weights can change between draws without rebuilding.
+    # draw removes the item drawn (weight -> 0) until restore puts every removed item back.
+    def __init__(self, weights):
+        self.n = len(weights)
+        self.top = 1 << (self.n.bit_length() - 1) if self.n > 0 else 0  # largest power of 2 <= n
+        self.removed = dict()  # item -> weight it will get back at restore
+        self.build(weights)
+
+    @classmethod
+    def from_state(cls, state):
+        # rebuild a sampler saved by state, so draws continue exactly as they would have
+        F = cls(state['weights'])
+        F.tree = np.asarray(state['tree']).tolist()
+        F.updates = int(state['updates'])
+        return F
+
+
+    def state(self):
+        # weights & the tree exactly as they are (rebuilding the tree from weights can differ by floating point drift).
+        # Only meaningful when nothing is removed, i.e. right after restore.
+        assert not self.removed, 'restore before saving state'
+        return {'weights': self.weights.copy(), 'tree': np.array(self.tree, dtype=float), 'updates': self.updates}
+
+
+    def build(self, weights):
+        # O(n) rebuild: tree[i] = sum of weights over (i - lowbit(i), i] (1-based)
+        self.weights = np.array(weights, dtype=float)
+        self.updates = 0
+        cs = np.concatenate([[0], np.cumsum(self.weights)])
+        i = np.arange(1, self.n+1)
+        self.tree = np.concatenate([[0], cs[i] - cs[i - (i & -i)]]).tolist()
+
+    def add(self, idx, delta):
+        i = idx + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        # sum of all current weights
+        i = self.n
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def update(self, idx, w):
+        # set the weights of items idx; items drawn since the last restore get their new weight back at restore
+        for i, x in zip(np.atleast_1d(idx).tolist(), np.atleast_1d(w).tolist()):
+            if i in self.removed:
+                self.removed[i] = x
+            else:
+                self.add(i, x - self.weights[i])
+                self.weights[i] = x
+            self.updates += 1
+        if self.updates > 10 * self.n:  # rebuild occasionally so floating point drift cannot accumulate
+            self.build(self.weights)  # drawn items have weight 0 here, so they stay out until restore
+
+    def draw(self, rng):
+        # draw an item with probability proportional to its weight & remove it; None if every remaining weight is 0
+        while True:
+            total = self.total()
+            if total <= 0:
+                return None
+            u = rng.random() * total
+            pos = 0
+            step = self.top
+            while step > 0:
+                if pos + step <= self.n and self.tree[pos+step] <= u:
+                    pos += step
+                    u -= self.tree[pos]
+                step >>= 1
+            if pos < self.n and self.weights[pos] > 0:
+                break
+            # floating point drift landed on an empty item - clean it up & redraw
+            self.build(self.weights)
+        self.removed[pos] = self.weights[pos]
+        self.add(pos, -self.weights[pos])
+        self.weights[pos] = 0
+        return pos
+
+    def restore(self):
+        # put back every item drawn since the last restore
+        removed, self.removed = self.removed, dict()
+        for i, w in removed.items():
+            self.add(i, w - self.weights[i])
+            self.weights[i] = w
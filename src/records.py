@@ -0,0 +1,48 @@
+from . import *
+
+class RecordBuffer():
+    # Columnar record storage for one record type: a preallocated numpy structured array that grows geometrically.
+    # append copies one step's columns into place, so recording creates no per-step DataFrames or dicts;
+    # to_df builds a single DataFrame for everything recorded since the last clear when results are saved.
+    # Columns listed in labels hold integer codes (node, county, or district index) that to_df maps through labels[column].
+    def __init__(self, fields, labels=None, capacity=1024):
+        self.dtype  = np.dtype(fields)
+        self.labels = dict() if labels is None else labels
+        self.data   = np.zeros(capacity, dtype=self.dtype)
+        self.n      = 0
+
+    def __len__(self):
+        return self.n
+
+    def reserve(self, rows):
+        if rows > len(self.data):
+            data = np.zeros(max(2 * len(self.data), rows), dtype=self.dtype)
+            data[:self.n] = self.data[:self.n]
+            self.data = data
+
+    def append(self, rows, **cols):
+        # add rows rows; each column is a scalar or an array of length rows
+        self.reserve(self.n + rows)
+        block = self.data[self.n:self.n+rows]
+        for c, x in cols.items():
+            block[c] = x
+        self.n += rows
+
+    def to_df(self, **const):
+        # DataFrame of every row since the last clear, with constant columns const first (e.g. random_seed)
+        X = self.data[:self.n]
+        cols = {c: self.labels[c][X[c]] if c in self.labels else X[c] for c in self.dtype.names}
+        return pd.DataFrame({**{c: np.full(self.n, x) for c, x in const.items()}, **cols})
+
+    def clear(self):
+        self.n = 0
+
+    def state(self):
+        # rows since the last clear, for MCMC.snapshot & checkpoints
+        return self.data[:self.n].copy()
+
+    def load(self, rows):
+        self.clear()
+        self.reserve(len(rows))
+        self.data[:len(rows)] = rows
+        self.n = len(rows)
@@ -0,0 +1,196 @@
+from .multichain import *
+import queue, itertools as it
+
+################# Chain scheduler #################
+# Runs every chain described by a job spec on all cores without any prompts.  Example spec (json):
+# {
+#     "proposals"     : ["planh2316", "plans2168"],
+#     "levels"        : ["cntyvtd"],
+#     "contracts"     : ["proposal"],
+#     "seeds"         : {"start": 1000, "stop": 1080},    (or a list of seeds)
+#     "max_steps"     : 3000,
+#     "segment_steps" : 500,     (optional - split each chain into resumable segments of this many steps)
+#     "time_budget"   : 3600,    (optional - seconds a segment may run before the rest of its chain is requeued)
+#     "workers"       : 80,
+#     "retries"       : 3,
+#     "opts"          : {"abbr": "TX", "report_period": 25, "yolo_length": 10}
+# }
+
+def proposal_defaults(proposal):
+    # pop_deviation_target & defect_cap by chamber (5th character of proposal: c=congress, s=state senate, h=state house)
+    defaults = {'c': {'pop_deviation_target':  0.01, 'defect_cap': 60},
+                's': {'pop_deviation_target': 10.0 , 'defect_cap': 35},
+                'h': {'pop_deviation_target': 10.0 , 'defect_cap': 10}}
+    if proposal[4] not in defaults:
+        raise Exception(f'unknown proposal {proposal}')
+    return defaults[proposal[4]]
+
+
+@dataclasses.dataclass
+class JobSpec():
+    # Every (proposal, level, contract, seed) combination is one chain.
+    proposals     : typing.List
+    levels        : typing.List = default_factory(['cntyvtd'])
+    contracts     : typing.List = default_factory(['proposal'])
+    seeds         : typing.Any  = default_factory([0])
+    max_steps     : int = 3000
+    segment_steps : float = np.inf
+    time_budget   : float = np.inf
+    workers       : int = multiprocessing.cpu_count()
+    retries       : int = 3
+    opts          : typing.Dict = default_factory(dict())
+
+    def __post_init__(self):
+        if isinstance(self.seeds, dict):
+            self.seeds = np.arange(self.seeds['start'], self.seeds['stop'])
+        self.seeds = np.atleast_1d(self.seeds).tolist()
+        # json has no infinity, so null means no limit
+        self.segment_steps = np.inf if self.segment_steps is None else self.segment_steps
+        self.time_budget   = np.inf if self.time_budget   is None else self.time_budget
+
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'r') as f:
+            return cls(**json.load(f))
+
+
+    def configs(self):
+        # (proposal, level, contract) of every distinct MCMC setup
+        return list(it.product(self.proposals, self.levels, self.contracts))
+
+
+    def mcmc_opts(self, proposal, level, contract):
+        opts = {**proposal_defaults(proposal), **self.opts, 'proposal':proposal, 'level':level, 'contract':contract, 'max_steps':self.max_steps}
+        if self.segment_steps < np.inf or self.time_budget < np.inf:
+            # Save only when a segment's run_chain returns, just before its snapshot is taken.  A segment that crashes has uploaded
+            # nothing past the snapshot its retry starts from, so rerunning it cannot duplicate rows.  (Saving every save_period steps
+            # would not be safe: a segment cut short by time_budget ends off the save_period grid, & the next one may save then crash.)
+            opts['save_period'] = 0
+        return opts
+
+
+def scheduler_worker(wid, protos, specs, inbox, results, progress, segment_steps, time_budget):
+    # Runs in a forked child: ask for a task, run that chain segment, report back, repeat until sent None.
+    attached = dict()
+    while True:
+        results.put(('ready', wid))
+        task = inbox.get()
+        if task is None:
+            return
+        try:
+            key = task['key']
+            if key not in attached:
+                attached[key] = SharedArrays.attach(specs[key])
+            M = protos[key]
+            C = M.spawn(task['seed'], PartitionState(**attached[key][0], assignment=M.partition.assignment.copy()))
+            if task['snapshot'] is not None:
+                C.load_snapshot(task['snapshot'])
+            C.progress = progress
+            finished = C.run_chain(steps=segment_steps, time_budget=time_budget)
+            results.put(('done', wid, task, None if finished else C.snapshot()))
+        except Exception as e:
+            results.put(('failed', wid, task, repr(e)))
+
+
+@dataclasses.dataclass
+class Scheduler():
+    # Keeps every core busy until all chains in spec are finished.
+    # Workers ask for a new task whenever they are idle, so a slow seed never holds up the rest of a batch.
+    # A task is one segment of one chain; when a segment ends before its chain does, the chain's snapshot goes back
+    # on the queue & any idle worker picks it up.  Tasks that raise or whose worker dies are requeued up to spec.retries times.
+    spec          : JobSpec
+    report_period : float = 60  # seconds between progress reports
+
+    def run(self):
+        ctx = multiprocessing.get_context('fork')
+        spec = self.spec
+        # Build each MCMC setup once, before forking, so workers inherit it & share its graph arrays (see multichain.py)
+        self.protos = {key: MCMC(**spec.mcmc_opts(*key)) for key in spec.configs()}
+        shared = {key: SharedArrays(M.partition.static()) for key, M in self.protos.items()}
+        specs = {key: S.spec for key, S in shared.items()}
+        self.pending = collections.deque({'key':key, 'seed':seed, 'snapshot':None, 'attempt':0}
+                                         for key in spec.configs() for seed in spec.seeds)
+        self.remaining = len(self.pending)
+        self.failed = list()
+        results = ctx.Queue()
+        progress = ctx.Value('q', 0)
+        workers, inboxes, running, idle = dict(), dict(), dict(), set()
+
+        def start(wid):
+            inboxes[wid] = ctx.Queue()
+            workers[wid] = ctx.Process(target=scheduler_worker, args=(wid, self.protos, specs, inboxes[wid], results, progress,
+                                                                      spec.segment_steps, spec.time_budget))
+            workers[wid].start()
+
+        def dispatch():
+            while idle and self.pending:
+                wid = idle.pop()
+                running[wid] = self.pending.popleft()
+                inboxes[wid].put(running[wid])
+
+        try:
+            self.start_time = time.time()
+            last_report = self.start_time
+            for wid in range(max(1, min(spec.workers, self.remaining))):
+                start(wid)
+            while self.remaining > 0:
+                try:
+                    msg = results.get(timeout=1)
+                except queue.Empty:
+                    msg = None
+                if msg is not None:
+                    wid = msg[1]
+                    if msg[0] == 'ready':
+                        if wid not in running:  # stale if its worker died & was replaced after sending it
+                            idle.add(wid)
+                    elif msg[0] == 'done':
+                        task = running.pop(wid)
+                        if msg[3] is None:
+                            self.remaining -= 1
+                        else:  # chain not finished - requeue its next segment
+                            self.pending.append({**task, 'snapshot':msg[3], 'attempt':0})
+                    elif msg[0] == 'failed':
+                        self.retry(running.pop(wid), msg[3])
+                # replace workers that died (killed, out of memory, ...) & requeue the task they held
+                for wid, p in workers.items():
+                    if not p.is_alive():
+                        idle.discard(wid)
+                        if wid in running:
+                            self.retry(running.pop(wid), f'worker exited with code {p.exitcode}')
+                        start(wid)
+                dispatch()
+                if time.time() - last_report >= self.report_period:
+                    last_report = time.time()
+                    self.report(progress.value, len(running))
+            for wid in workers:
+                inboxes[wid].put(None)
+            for p in workers.values():
+                p.join()
+            self.report(progress.value, 0)
+        finally:
+            # on an error or interrupt, stop workers still running so none outlives the shared arrays they map
+            for p in workers.values():
+                if p.is_alive():
+                    p.terminate()
+            for p in workers.values():
+                p.join()
+            for S in shared.values():
+                S.close()
+        return self.failed
+
+
+    def retry(self, task, err):
+        key = '_'.join(task['key'])
+        if task['attempt'] < self.spec.retries:
+            print(f'{key} random_seed {task["seed"]} failed ({err}) - requeueing', flush=True)
+            self.pending.append({**task, 'attempt':task['attempt']+1})
+        else:
+            print(f'{key} random_seed {task["seed"]} failed ({err}) {task["attempt"]+1} times - giving up', flush=True)
+            self.failed.append(task)
+            self.remaining -= 1
+
+
+    def report(self, steps, busy):
+        elapsed = time.time() - self.start_time
+        print(f'{busy} busy workers, {self.remaining} chains left, {len(self.failed)} failed: {steps} steps in {time_formatter(elapsed)}, {steps / max(elapsed, 1e-9):.2f} steps/sec', flush=True)
@@ -0,0 +1,160 @@
+from . import *
+import threading, queue
+
+################# Background result sink #################
+# MCMC.save_results hands its records to a ResultSink & continues immediately.
+# A writer thread concatenates each batch & writes it as a local Parquet file, partitioned by record type & random_seed:
+#     root/<src>/random_seed=<seed>/<first plan>-<last plan>.parquet
+# An uploader thread then forwards written files, oldest first, to the warehouse with exponential backoff.
+# The chain only waits if the writer falls queue_size batches behind, and an upload outage loses nothing -
+# every batch is on local disk before upload is attempted, and anything not uploaded at close is listed in root/pending.json.
+# A batch with overwrite set (the first of a chain started from plan 0) first clears its seed's directory, so a rerun never mixes in old files.
+
+class BigQueryUploader():
+    # default uploader: append (or overwrite) each batch into the chain's BigQuery table for its record type
+    def __init__(self, tbls):
+        self.tbls = tbls
+
+    def __call__(self, src, df, overwrite):
+        load_table(tbl=self.tbls[src], df=df, overwrite=overwrite)
+
+
+class ResultSink():
+    def __init__(self, root, uploader=None, queue_size=8, backoff=5, max_backoff=600, close_timeout=3600):
+        self.root = pathlib.Path(root)
+        self.uploader = uploader
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.close_timeout = close_timeout  # seconds close keeps retrying uploads before giving up & writing pending.json
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = collections.deque()  # (src, path, df, overwrite) written but not yet uploaded, in order
+        self.cleared = set()  # seed directories emptied by an overwrite - earlier pending.json entries in them are stale
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closing = False
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+        self.upload_thread = None
+        if self.uploader is not None:
+            self.upload_thread = threading.Thread(target=self.upload_loop, daemon=True)
+            self.upload_thread.start()
+
+
+    def put(self, src, recs, overwrite=False):
+        # queue a list of record DataFrames of type src; concatenating & writing happen on the writer thread
+        self.queue.put((src, recs, overwrite))
+
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            src, recs, overwrite = item
+            df = pd.concat(recs, axis=0, ignore_index=True)
+            path = None
+            try:
+                folder = self.seed_dir(src, df)
+                if overwrite:
+                    shutil.rmtree(folder, ignore_errors=True)
+                    self.cleared.add(folder)
+                path = folder / f'{df["plan"].min()}-{df["plan"].max()}.parquet'
+                path.parent.mkdir(parents=True, exist_ok=True)
+                df.to_parquet(path, index=False)
+            except Exception as e:
+                # keep the batch in memory so it can still be uploaded, or saved by close if there is no uploader
+                print(f'could not write {src} records to {path} ({e!r}) - keeping them in memory', flush=True)
+                path = None
+            if self.uploader is not None or path is None:
+                with self.lock:
+                    self.pending.append((src, path, df if path is None else None, overwrite))
+                self.wake.set()
+            self.queue.task_done()
+
+
+    def seed_dir(self, src, df):
+        return self.root / src / f'random_seed={df["random_seed"].iloc[0]}'
+
+
+    def flush(self):
+        # wait until every batch put so far is written locally (uploads may still be pending)
+        self.queue.join()
+
+
+    def upload_loop(self):
+        delay = self.backoff
+        while True:
+            with self.lock:
+                item = self.pending[0] if self.pending else None
+            if item is None:
+                if self.closing and not self.writer.is_alive():
+                    return
+                self.wake.wait(timeout=1)
+                self.wake.clear()
+                continue
+            src, path, df, overwrite = item
+            try:
+                self.uploader(src, pd.read_parquet(path) if df is None else df, overwrite)
+                with self.lock:
+                    self.pending.popleft()
+                delay = self.backoff
+            except Exception as e:
+                if self.closing and time.time() > self.close_deadline:
+                    return
+                print(f'upload of {src} records failed ({e!r}) - retrying in {delay}sec', flush=True)
+                time.sleep(min(delay, max(self.close_deadline - time.time(), 0)) if self.closing else delay)
+                delay = min(2 * delay, self.max_backoff)
+
+
+    def close(self):
+        # Write everything queued & wait for uploads to finish (up to close_timeout seconds).
+        # Returns True if everything was uploaded; otherwise the batches left over are listed in root/pending.json.
+        self.close_deadline = time.time() + self.close_timeout
+        self.closing = True
+        self.queue.put(None)
+        self.writer.join()
+        if self.upload_thread is not None:
+            self.wake.set()
+            self.upload_thread.join()
+        with self.lock:  # without an uploader, only batches that could not be written are pending
+            pending = list(self.pending)
+        manifest = self.root / 'pending.json'
+        if not pending and not (self.cleared and manifest.exists()):
+            return True
+        entries = list()
+        if manifest.exists():  # left over from an earlier close - keep those first, except files an overwrite has since removed
+            with open(manifest, 'r') as f:
+                entries = [e for e in json.load(f) if pathlib.Path(e['path']).parent not in self.cleared]
+        if not pending:
+            if entries:
+                with open(manifest, 'w') as f:
+                    json.dump(entries, f, indent=4)
+            else:
+                manifest.unlink()
+            return True
+        for src, path, df, overwrite in pending:
+            if path is None:  # last resort for batches that never made it to disk
+                path = self.seed_dir(src, df) / f'unsaved_{time.time_ns()}.pkl'
+                path.parent.mkdir(parents=True, exist_ok=True)
+                df.to_pickle(path)
+            entries.append({'src':src, 'path':str(path), 'overwrite':overwrite})
+        with open(manifest, 'w') as f:
+            json.dump(entries, f, indent=4)
+        print(f'{len(pending)} batches were not {"uploaded" if self.uploader is not None else "written"} - see {manifest}', flush=True)
+        return False
+
+
+def upload_pending(manifest, uploader):
+    # retry the uploads listed in a pending.json written by ResultSink.close, in order; stops at the first failure
+    manifest = pathlib.Path(manifest)
+    with open(manifest, 'r') as f:
+        entries = json.load(f)
+    while entries:
+        e = entries[0]
+        path = pathlib.Path(e['path'])
+        uploader(e['src'], pd.read_parquet(path) if path.suffix == '.parquet' else pd.read_pickle(path), e['overwrite'])
+        entries.pop(0)
+        with open(manifest, 'w') as f:
+            json.dump(entries, f, indent=4)
+    manifest.unlink()
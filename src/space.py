@@ -1,4 +1,6 @@
 from .data import *
+from .graphfile import *
+import pickle
 
 @dataclasses.dataclass
 class Space(Data):
@@ -17,7 +19,7 @@ class Space(Data):
         
         self.stem = f'{self.state.abbr}_{self.census_yr}_{self.district_type}_{self.proposal}'
         self.dataset = f'{root_bq}.{self.stem}'
-        bqclient.create_dataset(self.dataset, exists_ok=True)
+        create_dataset(self.dataset)
         for src in self.sources:
             self.path[src] = data_path / f'proposals/{self.stem.replace("_", "/")}/{src}'
             if src in ['proposal', 'districts']:
@@ -25,7 +27,8 @@ class Space(Data):
             else:
                 self.tbls[src] = f'{self.dataset}.{self.level}_{self.contract}_{src}'
         self.csv     = self.path['proposal'] / f'{self.proposal.upper()}.csv'
-        self.gpickle = self.path['graph']    / f'{self.level}_{self.contract}_graph.gpickle'
+        self.graph_path = self.path['graph'] / f'{self.level}_{self.contract}_graph'  # compact graph directory - see graphfile.py
+        self.gpickle = self.path['graph']    / f'{self.level}_{self.contract}_graph.gpickle'  # legacy format, converted on first use
 
         for src in self.sources:
             self.get(src)
@@ -33,13 +36,21 @@ class Space(Data):
 
     def get_graph(self):
         src = 'graph'
+        # self.graph is a CompactGraph; use self.graph.to_networkx() where a networkx graph is needed
         try:
-            self.graph = nx.read_gpickle(self.gpickle)
+            self.graph = CompactGraph(self.graph_path)
             rpt(f'using existing graph')
             return
-        except:
-            rpt(f'creating graph')
-        self.gpickle.parent.mkdir(parents=True, exist_ok=True)
+        except Exception:
+            pass
+        if self.gpickle.exists():
+            rpt(f'converting gpickle graph')
+            with open(self.gpickle, 'rb') as f:
+                write_graph(self.graph_path, pickle.load(f))
+            self.graph = CompactGraph(self.graph_path)
+            return
+        rpt(f'creating graph')
+        self.graph_path.parent.mkdir(parents=True, exist_ok=True)
         # what attributes will be stored in nodes & edges
         self.node_attr = {'geoid', 'county', 'district', 'total_pop', f'seats_{self.district_type} as seats', 'aland', 'perim'}.union(self.node_attr)
         self.edge_attr = {'distance', 'shared_perim'}.union(self.edge_attr)
@@ -86,7 +97,7 @@ from (
                 if len(comp) > 1:
                     # district disconnected - keep largest component and "dissolve" smaller ones into other contiguous districts.
                     # May create population deviation which will be corrected during MCMC.
-                    print(f'regrouping to connect components of district {D} with component {[len(c) for c in comp]}')
+                    rpt(f'regrouping to connect components of district {D} with component {[len(c) for c in comp]}', end='\n')
                     connected = False
                     self.disconnected_districts.add(D)
                     
@@ -114,7 +125,8 @@ from (
                 else:
                     # fail - disconnected old district - undo and try again
                     self.graph.nodes[n]['district'] = D_old
-        nx.write_gpickle(self.graph, self.gpickle)
+        write_graph(self.graph_path, self.graph)
+        self.graph = CompactGraph(self.graph_path)
             
             
     def get_proposal(self):
@@ -0,0 +1,120 @@
+from .recom import *
+
+################# Synthetic graphs #################
+# Planar graphs with the node & edge attributes Space.get_graph produces, so chains can run without any BigQuery tables (see benchmark.py).
+#     nodes: geoid, county, district, total_pop, seats, aland, perim
+#     edges: shared_perim, distance
+# Nodes are the cells of a grid or of a Voronoi diagram of uniform random points, measured in miles & square miles.
+# Counties are square tiles of the map & population is a lognormal background raised by a few Gaussian "cities".
+# The initial plan cuts population-balanced subtrees off one spanning tree, so every district starts connected.
+
+def grid_cells(n, rng, side=1.0):
+    # about n side x side squares in a near-square grid: centers, aland, perim, edges (i < j), & shared_perim
+    rows = max(int(round(np.sqrt(n))), 1)
+    cols = max(int(np.ceil(n / rows)), 1)
+    r, c = np.divmod(np.arange(rows * cols), cols)
+    pts = (np.column_stack([c, r]) + 0.5) * side
+    idx = np.arange(rows * cols).reshape(rows, cols)
+    edges = np.concatenate([np.column_stack([idx[:, :-1].ravel(), idx[:, 1:].ravel()]),
+                            np.column_stack([idx[:-1, :].ravel(), idx[1:, :].ravel()])])
+    return pts, np.full(len(pts), side**2), np.full(len(pts), 4 * side), edges, np.full(len(edges), side)
+
+
+def voronoi_cells(n, rng, side=1.0):
+    # Voronoi cells of n uniform random points, clipped to a square sized so cells average side^2 square miles
+    import shapely
+    w = side * np.sqrt(n)
+    pts = rng.uniform(0, w, (n, 2))
+    box = shapely.box(0, 0, w, w)
+    cells = shapely.intersection(shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(pts), extend_to=box)), box)
+    # voronoi_polygons does not promise to keep the input order - match each point to the cell containing it
+    i, j = shapely.STRtree(cells).query(shapely.points(pts), predicate='within')
+    cells = cells[j[np.argsort(i)]]
+    # neighbors are cells sharing a boundary of positive length, as in the edges query of Space.get_graph
+    a, b = shapely.STRtree(cells).query(cells, predicate='touches')
+    a, b = a[a < b], b[a < b]
+    shared = shapely.length(shapely.intersection(cells[a], cells[b]))
+    keep = shared > 0
+    return pts, shapely.area(cells), shapely.length(cells), np.column_stack([a[keep], b[keep]]), shared[keep]
+
+
+def synthetic_pop(pts, rng, total_pop, cities, empty, cap):
+    # lognormal background times Gaussian cities, with a fraction empty of unpopulated cells, scaled to total_pop.
+    # No cell may exceed cap, so every node stays far smaller than a district, as at the real levels.
+    w = pts.max(axis=0)
+    density = np.ones(len(pts))
+    for k in range(cities):
+        center = rng.uniform(0, 1, 2) * w
+        radius = rng.uniform(0.01, 0.08) * w.max()
+        density += rng.uniform(5, 50) * np.exp(-((pts - center)**2).sum(axis=1) / (2 * radius**2))
+    pop = density * rng.lognormal(0, 1, len(pts)) * (rng.random(len(pts)) >= empty)
+    for k in range(20):  # capping & rescaling converges in a few rounds
+        pop = np.minimum(pop / pop.sum() * total_pop, cap)
+    return np.round(pop).astype(np.int64)
+
+
+def tree_partition(indptr, indices, pop, n_districts, rng):
+    # n_districts connected districts of nearly equal population.
+    # Draw one spanning tree and repeatedly cut off the remaining subtree whose population is closest to the ideal
+    # for what is left (remaining population / remaining districts), so errors do not pile up in the last district.
+    # Removing a subtree leaves a tree, so every district, including the remainder, is connected.
+    parent = wilson_tree(indptr, indices, rng)
+    order = preorder(parent)
+    pos = np.empty_like(order)
+    pos[order] = np.arange(len(order))
+    size = subtree_sums(parent, order, np.ones(len(order), dtype=np.int64))
+    sub = subtree_sums(parent, order, pop).astype(float)
+    par = parent.tolist()
+    remaining = float(pop.sum())
+    district = np.full(len(parent), -1)
+    free = parent >= 0  # nodes whose remaining subtree can still be cut off
+    for d in range(n_districts - 1):
+        target = remaining / (n_districts - d)
+        v = int(np.argmin(np.where(free, np.abs(sub - target), np.inf)))
+        block = order[pos[v]:pos[v]+size[v]]
+        block = block[district[block] < 0]
+        district[block] = d
+        free[block] = False
+        up = list()
+        i = par[v]
+        while i >= 0:
+            up.append(i)
+            i = par[i]
+        sub[up] -= sub[v]
+        remaining -= sub[v]
+    district[district < 0] = n_districts - 1
+    return district
+
+
+def synthetic_graph(n=1000, kind='grid', n_districts=38, n_counties=254, total_pop=29145505, cities=20, empty=0.05, max_share=0.2, side=1.0, random_seed=0):
+    # networkx graph of about n nodes shaped like the output of Space.get_graph with n_districts districts.
+    # kind is 'grid' or 'voronoi'; no node holds more than max_share of an ideal district's population.
+    rng = np.random.default_rng(random_seed)
+    cells = {'grid': grid_cells, 'voronoi': voronoi_cells}
+    if kind not in cells:
+        raise Exception(f'kind must be one of {tuple(cells)} ... got {kind}')
+    pts, aland, perim, edges, shared = cells[kind](n, rng, side)
+    n = len(pts)
+    pop = synthetic_pop(pts, rng, total_pop, cities, empty, max_share * total_pop / n_districts)
+
+    # counties are the tiles of a t x t grid over the map
+    t = max(int(np.ceil(np.sqrt(n_counties))), 1)
+    tile = np.minimum((pts / (pts.max(axis=0) + 1e-9) * t).astype(np.int64), t - 1)
+    county = tile[:, 1] * t + tile[:, 0]
+
+    src = np.concatenate([edges[:,0], edges[:,1]])
+    dst = np.concatenate([edges[:,1], edges[:,0]])
+    o = np.lexsort((dst, src))
+    indptr = np.zeros(n+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(src, minlength=n))
+    district = tree_partition(indptr, dst[o], pop, n_districts, rng) + 1
+
+    geoids = [f'{i:0{len(str(n))}d}' for i in range(n)]  # zero padded, so sorted geoids keep node order
+    seats = pop * n_districts / pop.sum()
+    distance = np.sqrt(((pts[edges[:,0]] - pts[edges[:,1]])**2).sum(axis=1))
+    G = nx.Graph()
+    G.add_nodes_from((g, {'county': f'{c:03d}', 'district': d, 'total_pop': p, 'seats': s, 'aland': a, 'perim': r})
+                     for g, c, d, p, s, a, r in zip(geoids, county.tolist(), district.tolist(), pop.tolist(), seats.tolist(), aland.tolist(), perim.tolist()))
+    G.add_edges_from((geoids[u], geoids[v], {'shared_perim': s, 'distance': d})
+                     for u, v, s, d in zip(edges[:,0].tolist(), edges[:,1].tolist(), shared.tolist(), distance.tolist()))
+    return G